@@ -6,17 +6,21 @@ __license__ = 'MIT'
 
 # Public API
 from . import _model as model, _field as field
-from ._api import on_odm_setup_fields_role, on_odm_setup_fields_user
+from ._api import on_odm_setup_fields_role, on_odm_setup_fields_user, on_metric, on_repeated_lookup, get_metrics, \
+    reset_metrics
 from ._model import User, Role, ODMRole, ODMUser, ODMBlockedUser, ODMFollower
+from ._snapshot import UserSnapshot, RoleSnapshot
+from ._async_driver import AsyncStorage
+from ._transfer import export_data, import_data, validate_refs
 
 # Locally needed imports
 from semaver import Version as _Version
 
 
 def plugin_load():
-    from pytsite import reg, util
+    from pytsite import reg, router, util
     from plugins import auth, odm
-    from . import _driver
+    from . import _driver, _eh, _role_registry
 
     # ODM models
     role_cls = reg.get('auth_storage_odm.role_odm_class', 'plugins.auth_storage_odm.ODMRole')
@@ -26,65 +30,30 @@ def plugin_load():
     odm.register_model('follower', ODMFollower)
     odm.register_model('blocked_user', ODMBlockedUser)
 
+    # Load roles into memory
+    _role_registry.registry.load()
+
     # Register storage driver
     auth.register_storage_driver(_driver.Storage())
 
+    # Event handlers
+    router.on_dispatch(_eh.router_dispatch)
 
-def plugin_update(v_from: _Version):
-    # Field 'uid' added to users and roles
-    if v_from <= '2.3':
-        from pytsite import console, mongodb
-        from plugins import odm
-
-        for c in ('users', 'roles'):
-            col = mongodb.get_collection(c)
-            for d in col.find():
-                col.update_one({'_id': d['_id']}, {'$set': {'uid': str(d['_id'])}})
-                console.print_info('Document updated: {}:{}'.format(c, d['_id']))
-
-        odm.clear_cache('role')
-        odm.clear_cache('user')
-        odm.reindex('role')
-        odm.reindex('user')
-
-    if v_from <= '3.2':
-        import re
-        from pytsite import console, mongodb
-        from plugins import odm
 
-        for c in ('users', 'roles'):
-            col = mongodb.get_collection(c)
-            for d in col.find():
-                col.update_one({'_id': d['_id']}, {'$set': {'uid': d['_ref']}})
-                console.print_info('Document updated: {}:{}'.format(c, d['_id']))
+def plugin_load_console():
+    from pytsite import console
+    from . import _cc
 
-        odm.clear_cache('role')
-        odm.clear_cache('user')
-        odm.reindex('role')
-        odm.reindex('user')
+    console.register_command(_cc.FetchPictures())
+    console.register_command(_cc.Migrate())
+    console.register_command(_cc.ReconcileCounters())
+    console.register_command(_cc.SweepRelations())
+    console.register_command(_cc.Bench())
+    console.register_command(_cc.Export())
+    console.register_command(_cc.Import())
 
-        db_obj_id_re = re.compile('[a-z:]+([0-9a-f]{24})$')
-        for m in odm.get_registered_models():
-            mock = odm.dispense(m)
-            for f_name, f in mock.fields.items():
-                for d in mock.collection.find():
-                    f_new_value = None
 
-                    if isinstance(f, field.User) and d[f_name]:
-                        f_new_value = '{}:{}'.format('user', db_obj_id_re.sub('\\1', d[f_name]))
-
-                    if isinstance(f, (field.Users, field.Roles)) and d[f_name]:
-                        auth_model = 'role' if isinstance(f, field.Roles) else 'user'
-                        f_new_value = ['{}:{}'.format(auth_model, db_obj_id_re.sub('\\1', v)) for v in d[f_name]]
-
-                    if f_new_value:
-                        mock.collection.update_one({'_id': d['_id']}, {'$set': {f_name: f_new_value}})
-                        console.print_info('Document updated: {}:{}'.format(m, d['_id']))
-
-            odm.clear_cache(m)
-
-    if v_from <= '3.4':
-        from plugins import odm
+def plugin_update(v_from: _Version):
+    from . import _migration
 
-        odm.reindex('role')
-        odm.reindex('user')
+    _migration.run(v_from)
@@ -0,0 +1,183 @@
+"""PytSite Auth ODM Storage User Activity Write-Behind Buffer
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import atexit as _atexit
+import threading as _threading
+from time import monotonic as _monotonic, sleep as _sleep
+from typing import Any, Dict
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pytsite import logger, reg
+from plugins import odm
+from . import _cache
+
+# Buffered fields and MongoDB operators used to write them
+FIELDS = {
+    'last_activity': '$max',
+    'last_sign_in': '$max',
+    'last_ip': '$set',
+    'sign_in_count': '$inc',
+}
+
+
+def _merge(op: str, old: Any, new: Any) -> Any:
+    """Combine two values of a field written with operator `op`, `new` is the later one
+    """
+    if op == '$inc':
+        return (old or 0) + (new or 0)
+    elif op == '$max' and old is not None and new is not None:
+        return max(old, new)
+
+    return new
+
+
+class ActivityBuffer:
+    """Write-behind buffer for frequently updated user activity fields.
+
+    Updates are coalesced per user UID and periodically written to the database by a background thread using a single
+    bulk write. Values of `$inc` fields are stored as deltas. Values being written stay readable until they are in the
+    database, ones which failed to be written are returned to the buffer.
+    """
+
+    def __init__(self):
+        self._data = {}  # type: Dict[str, Dict[str, Any]]
+        self._flushing = {}  # type: Dict[str, Dict[str, Any]]
+        self._lock = _threading.Lock()
+        self._flush_lock = _threading.Lock()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return reg.get('auth_storage_odm.write_behind_interval', 5.0) > 0
+
+    def _start(self):
+        if self._thread:
+            return
+
+        self._thread = _threading.Thread(target=self._run, name='auth_storage_odm.activity', daemon=True)
+        self._thread.start()
+        _atexit.register(self.flush, reg.get('auth_storage_odm.write_behind_shutdown_timeout', 5.0))
+
+    def _run(self):
+        while True:
+            _sleep(reg.get('auth_storage_odm.write_behind_interval', 5.0))
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(e)
+
+    def put(self, uid: str, field_name: str, value: Any):
+        """Buffer a field value
+        """
+        with self._lock:
+            self._start()
+
+            fields = self._data.setdefault(uid, {})
+            fields[field_name] = _merge(FIELDS[field_name], fields.get(field_name), value) \
+                if field_name in fields else value
+
+    def get(self, uid: str, field_name: str, default: Any = None) -> Any:
+        """Get a buffered field value, including one which is being written
+        """
+        with self._lock:
+            fields = self._data.get(uid, {})
+            flushing = self._flushing.get(uid, {})
+            if field_name in fields and field_name in flushing:
+                return _merge(FIELDS[field_name], flushing[field_name], fields[field_name])
+            elif field_name in fields:
+                return fields[field_name]
+
+            return flushing.get(field_name, default)
+
+    def pop(self, uid: str) -> Dict[str, Any]:
+        """Remove and return all buffered values of a user
+        """
+        with self._lock:
+            self._flushing.pop(uid, None)
+            return self._data.pop(uid, {})
+
+    def _restore(self, items: list):
+        """Return values which have not been written back to the buffer
+        """
+        with self._lock:
+            for uid, fields in items:
+                if uid not in self._flushing:
+                    # User has been deleted meanwhile
+                    continue
+
+                pending = self._data.setdefault(uid, {})
+                for field_name, value in fields.items():
+                    pending[field_name] = _merge(FIELDS[field_name], value, pending[field_name]) \
+                        if field_name in pending else value
+
+            self._flushing = {}
+
+    def flush(self, timeout: float = None) -> int:
+        """Write buffered values to the database.
+
+        If `timeout` is given, values which were not written until it expired are discarded.
+        """
+        if not self._flush_lock.acquire(timeout=timeout if timeout is not None else -1):
+            logger.warn('Buffered user activity updates were not written, another flush is in progress')
+            return 0
+
+        try:
+            return self._flush(timeout)
+        finally:
+            self._flush_lock.release()
+
+    def _flush(self, timeout: float = None) -> int:
+        with self._lock:
+            self._flushing, self._data = self._data, {}
+            items = list(self._flushing.items())
+
+        if not items:
+            return 0
+
+        deadline = _monotonic() + timeout if timeout is not None else None
+        chunk_size = reg.get('auth_storage_odm.write_behind_chunk_size', 1000)
+        collection = odm.dispense('user').collection
+        written = 0
+
+        for i in range(0, len(items), chunk_size):
+            if deadline is not None and _monotonic() > deadline:
+                logger.warn('{} buffered user activity updates discarded'.format(len(items) - written))
+                with self._lock:
+                    self._flushing = {}
+                break
+
+            chunk = items[i:i + chunk_size]
+            requests = []
+            for uid, fields in chunk:
+                update = {}
+                for field_name, value in fields.items():
+                    update.setdefault(FIELDS[field_name], {})[field_name] = value
+                requests.append(UpdateOne({'uid': uid}, update))
+
+            try:
+                collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # Requests of an unordered write which did not fail have been applied
+                failed = {err['index'] for err in e.details.get('writeErrors', ())}
+                self._restore([item for n, item in enumerate(chunk) if n in failed] + items[i + chunk_size:])
+                raise
+            except Exception:
+                self._restore(items[i:])
+                raise
+
+            written += len(requests)
+
+            with self._lock:
+                for uid, _ in chunk:
+                    self._flushing.pop(uid, None)
+
+            for uid, _ in chunk:
+                _cache.users.rm(uid)
+
+        return written
+
+
+buffer = ActivityBuffer()
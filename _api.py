@@ -4,7 +4,9 @@ __author__ = 'Oleksandr Shepetko'
 __email__ = 'a@shepetko.com'
 __license__ = 'MIT'
 
+from typing import Dict
 from pytsite import events
+from . import _metrics
 
 
 def on_odm_setup_fields_role(handler, priority: int = 0):
@@ -17,3 +19,31 @@ def on_odm_setup_fields_user(handler, priority: int = 0):
     """Shortcut
     """
     events.listen('odm@model.setup_fields.user', handler, priority)
+
+
+def on_metric(handler, priority: int = 0):
+    """Shortcut
+
+    Handler receives `name` of a measured operation and its `duration` in seconds.
+    """
+    events.listen('auth_storage_odm@metric', handler, priority)
+
+
+def on_repeated_lookup(handler, priority: int = 0):
+    """Shortcut
+
+    Handler receives `name` and `key` of a lookup repeated during single request and `count` of repetitions.
+    """
+    events.listen('auth_storage_odm@repeated_lookup', handler, priority)
+
+
+def get_metrics() -> Dict[str, dict]:
+    """Get counters and timing histograms of storage operations
+    """
+    return _metrics.get_stats()
+
+
+def reset_metrics():
+    """Reset counters and timing histograms of storage operations
+    """
+    _metrics.reset()
@@ -0,0 +1,243 @@
+"""PytSite Auth ODM Storage asyncio Driver
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from datetime import datetime
+from typing import AsyncIterator, List, Tuple
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pytsite import reg, util
+from plugins import auth, odm, query
+from . import _bulk, _cache, _driver, _model, _query, _relations, _snapshot
+
+
+def _uid(user) -> str:
+    return user.uid if isinstance(user, auth.model.AbstractUser) else user
+
+
+class AsyncStorage:
+    """asyncio storage driver.
+
+    Works with Motor or any database object providing the same coroutine based API. Users and roles are returned as
+    read-only snapshots; relationships are stored in documents of the same shape ODM models produce and are created
+    only between existing users.
+    """
+
+    def __init__(self, db=None):
+        """Init.
+
+        If `db` is not given, Motor client with a connection pool is created using the application's database settings.
+        """
+        if db is None:
+            try:
+                from motor.motor_asyncio import AsyncIOMotorClient
+            except ImportError:
+                raise RuntimeError("Package 'motor' is required to use asyncio storage driver")
+
+            client = AsyncIOMotorClient(reg.get('db.host', 'localhost'), reg.get('db.port', 27017),
+                                        username=reg.get('db.user'), password=reg.get('db.password'),
+                                        ssl=reg.get('db.ssl', False),
+                                        maxPoolSize=reg.get('auth_storage_odm.async_pool_size', 100))
+            db = client[reg.get('db.database', 'test')]
+
+        self._db = db
+
+        self._role_cls = util.get_module_attr(reg.get(_driver._REG_ROLE_CLS, 'plugins.auth_storage_odm.Role'))
+        if not issubclass(self._role_cls, _model.Role):
+            raise TypeError("Subclass of {} expected, got {}. Please check the '{}' configuration parameter".
+                            format(auth.AbstractRole, type(self._role_cls), _driver._REG_ROLE_CLS))
+
+        self._user_cls = util.get_module_attr(reg.get(_driver._REG_USER_CLS, 'plugins.auth_storage_odm.User'))
+        if not issubclass(self._user_cls, _model.User):
+            raise TypeError("Subclass of {} expected, got {}. Please check the '{}' configuration parameter".
+                            format(auth.AbstractUser, type(self._user_cls), _driver._REG_USER_CLS))
+
+        # Collections and relationship document prototypes are resolved here, so coroutines never call the ODM
+        self._collections = {}
+        self._edge_protos = {}
+        for model in ('role', 'user', 'follower', 'blocked_user'):
+            mock = odm.dispense(model)
+            self._collections[model] = db[mock.collection.name]
+            if model in _relations.EDGE_COUNTERS:
+                self._edge_protos[model] = _bulk.entity_to_doc(mock)
+
+    def _collection(self, model: str):
+        """Get asynchronous collection of a model
+        """
+        return self._collections[model]
+
+    async def get_role(self, name: str = None, uid: str = None) -> _snapshot.RoleSnapshot:
+        if name:
+            q = {'name': name}
+        elif uid:
+            q = {'uid': uid}
+        else:
+            raise RuntimeError("Either role's name or UID must be specified")
+
+        doc = await self._collection('role').find_one(q)
+        if not doc:
+            raise auth.error.RoleNotFound(name)
+
+        return _snapshot.RoleSnapshot(doc, self._role_cls)
+
+    async def find_roles(self, query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                         skip: int = 0) -> AsyncIterator[_snapshot.RoleSnapshot]:
+        cursor = self._collection('role').find(_query.compile_query('role', query)).skip(skip)
+        if sort:
+            cursor.sort(sort)
+        if limit:
+            cursor.limit(limit)
+
+        async for doc in cursor:
+            yield _snapshot.RoleSnapshot(doc, self._role_cls)
+
+    async def count_roles(self, query: query.Query = None) -> int:
+        return await self._collection('role').count_documents(_query.compile_query('role', query))
+
+    async def get_user(self, login: str = None, nickname: str = None, uid: str = None,
+                       fields: List[str] = None) -> _snapshot.UserSnapshot:
+        if login is not None:
+            q = {'login': login}
+        elif nickname is not None:
+            q = {'nickname': nickname}
+        elif uid is not None:
+            q = {'uid': uid}
+        else:
+            raise RuntimeError('User search criteria was not specified')
+
+        doc = await self._collection('user').find_one(q, _snapshot.get_projection(fields))
+        if not doc:
+            raise auth.error.UserNotFound()
+
+        return _snapshot.UserSnapshot(doc, self._user_cls, fields is not None)
+
+    async def get_users(self, uids: List[str], fields: List[str] = None) -> List[_snapshot.UserSnapshot]:
+        """Get multiple users by UIDs using single query.
+
+        Users are returned in the order of `uids`, non-existent ones are skipped.
+        """
+        if not uids:
+            return []
+
+        cursor = self._collection('user').find({'uid': {'$in': list(set(uids))}}, _snapshot.get_projection(fields))
+        docs = {doc['uid']: doc async for doc in cursor}
+
+        return [_snapshot.UserSnapshot(docs[uid], self._user_cls, fields is not None) for uid in uids if uid in docs]
+
+    async def find_users(self, query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
+                         skip: int = 0, fields: List[str] = None) -> AsyncIterator[_snapshot.UserSnapshot]:
+        q = _query.compile_query('user', query)
+        cursor = self._collection('user').find(q, _snapshot.get_projection(fields)).skip(skip)
+        sort = _driver.Storage._get_users_sort(sort)
+        if sort:
+            cursor.sort(sort)
+        if limit:
+            cursor.limit(limit)
+
+        async for doc in cursor:
+            yield _snapshot.UserSnapshot(doc, self._user_cls, fields is not None)
+
+    async def count_users(self, query: query.Query = None) -> int:
+        return await self._collection('user').count_documents(_query.compile_query('user', query))
+
+    async def _inc_counters(self, deltas: dict):
+        requests = [UpdateOne({'_id': uid}, {'$inc': d}, upsert=True) for uid, d in deltas.items()]
+        await self._db[_relations.COUNTERS_COLLECTION].bulk_write(requests, ordered=False)
+
+        for uid in deltas:
+            _cache.users.rm(uid)
+
+    async def _add_edge(self, model: str, own_field: str, other_field: str, user: auth.model.AbstractUser,
+                        other_user: auth.model.AbstractUser) -> bool:
+        uids = {_uid(user), _uid(other_user)}
+        if await self._collection('user').count_documents({'uid': {'$in': list(uids)}}) != len(uids):
+            raise auth.error.UserNotFound()
+
+        oid = ObjectId()
+        now = datetime.now()
+        doc = dict(self._edge_protos[model], _id=oid, _ref='{}:{}'.format(model, oid), _created=now, _modified=now,
+                   **{own_field: _uid(user), other_field: _uid(other_user)})
+        try:
+            await self._collection(model).insert_one(doc)
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    async def _sub_edge(self, model: str, own_field: str, other_field: str, user, other_user) -> bool:
+        r = await self._collection(model).delete_one({own_field: _uid(user), other_field: _uid(other_user)})
+
+        return bool(r.deleted_count)
+
+    async def _has_edge(self, model: str, own_field: str, other_field: str, user, other_user) -> bool:
+        q = {own_field: _uid(user), other_field: _uid(other_user)}
+
+        return bool(await self._collection(model).find_one(q, {'_id': 0, own_field: 1}))
+
+    async def follow(self, user: auth.model.AbstractUser, user_to_follow: auth.model.AbstractUser) -> bool:
+        """Make a user follow another one.
+
+        Returns False if the user already follows.
+        """
+        if not await self._add_edge('follower', 'follower', 'follows', user, user_to_follow):
+            return False
+
+        await self._inc_counters({_uid(user): {'follows_count': 1}, _uid(user_to_follow): {'followers_count': 1}})
+
+        return True
+
+    async def unfollow(self, user: auth.model.AbstractUser, user_to_unfollow: auth.model.AbstractUser) -> bool:
+        """Make a user stop following another one.
+
+        Returns False if the user did not follow.
+        """
+        if not await self._sub_edge('follower', 'follower', 'follows', user, user_to_unfollow):
+            return False
+
+        await self._inc_counters({_uid(user): {'follows_count': -1}, _uid(user_to_unfollow): {'followers_count': -1}})
+
+        return True
+
+    async def block(self, user: auth.model.AbstractUser, user_to_block: auth.model.AbstractUser) -> bool:
+        """Make a user block another one.
+
+        Returns False if the user already blocks.
+        """
+        if not await self._add_edge('blocked_user', 'blocker', 'blocked', user, user_to_block):
+            return False
+
+        await self._inc_counters({_uid(user): {'blocked_users_count': 1}})
+
+        return True
+
+    async def unblock(self, user: auth.model.AbstractUser, user_to_unblock: auth.model.AbstractUser) -> bool:
+        """Make a user stop blocking another one.
+
+        Returns False if the user did not block.
+        """
+        if not await self._sub_edge('blocked_user', 'blocker', 'blocked', user, user_to_unblock):
+            return False
+
+        await self._inc_counters({_uid(user): {'blocked_users_count': -1}})
+
+        return True
+
+    async def is_follows(self, user, user_to_check) -> bool:
+        return await self._has_edge('follower', 'follower', 'follows', user, user_to_check)
+
+    async def is_blocks(self, user, user_to_check) -> bool:
+        return await self._has_edge('blocked_user', 'blocker', 'blocked', user, user_to_check)
+
+    async def count_relation(self, user, relation: str) -> int:
+        """Count related users: 'follows', 'followers' or 'blocked_users'
+        """
+        counter = relation + '_count'
+        if counter not in _relations.COUNTERS:
+            raise ValueError("Invalid relationship: '{}'".format(relation))
+
+        doc = await self._db[_relations.COUNTERS_COLLECTION].find_one({'_id': _uid(user)}, {counter: 1})
+
+        return (doc.get(counter) or 0) if doc else 0
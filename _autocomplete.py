@@ -0,0 +1,55 @@
+"""PytSite Auth ODM Storage Autocomplete Keys
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import re
+from typing import Iterable, List, Optional
+from pytsite import lang, util
+
+# Fields which autocomplete keys are built from
+FIELDS = ('login', 'nickname', 'first_name', 'last_name')
+
+# Keys are truncated, so prefixes longer than this match by their first characters only
+KEY_MAX_LENGTH = 32
+
+
+def normalize(s: str, language: str = None) -> str:
+    """Transliterate and normalize a string the same way nicknames are
+    """
+    return util.transform_str_2(s or '', language or lang.get_current()).lower()[:KEY_MAX_LENGTH]
+
+
+def get_keys(values: dict, language: str = None) -> List[str]:
+    """Build autocomplete keys from user's field values.
+
+    Keys are whole normalized values, their separate words and the full name, so any of them can be matched by prefix.
+    """
+    language = language or lang.get_current()
+    sources = [values.get(f) for f in FIELDS]
+    sources.append('{} {}'.format(values.get('first_name') or '', values.get('last_name') or ''))
+
+    keys = []
+    for s in sources:
+        key = normalize(s, language)
+        if not key:
+            continue
+
+        for k in [key] + key.split('-'):
+            if k and k not in keys:
+                keys.append(k)
+
+    return keys
+
+
+def get_query(prefix: str) -> Optional[dict]:
+    """Get query to match users by a prefix, which MongoDB answers with an index range scan.
+
+    Returns None if the prefix is empty after normalization.
+    """
+    prefix = normalize(prefix)
+    if not prefix:
+        return None
+
+    return {'autocomplete': {'$regex': '^' + re.escape(prefix)}}
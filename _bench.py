@@ -0,0 +1,240 @@
+"""PytSite Auth ODM Storage Benchmarks
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import random
+import tracemalloc
+from time import perf_counter
+from typing import Callable, Dict, List
+from bson import ObjectId
+from pymongo import InsertOne
+from pytsite import console, mongodb
+from plugins import auth, odm
+from semaver import Version
+from . import _autocomplete, _bulk, _cache, _field, _migration, _model, _relations, _role_registry
+
+# Prefix of logins, nicknames and role names of seeded entities
+PREFIX = 'bench-'
+
+_COLLIDING_NICKNAME = PREFIX + 'collide'
+
+
+def _insert(collection, docs_iter, chunk_size: int = 10000) -> int:
+    n = 0
+    requests = []
+    for doc in docs_iter:
+        requests.append(InsertOne(doc))
+        if len(requests) >= chunk_size:
+            collection.bulk_write(requests, ordered=False)
+            n += len(requests)
+            requests = []
+
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+        n += len(requests)
+
+    return n
+
+
+def cleanup():
+    """Delete seeded entities
+    """
+    users = odm.dispense('user').collection
+    uids = [d['uid'] for d in users.find({'login': {'$regex': '^' + PREFIX}}, {'_id': 0, 'uid': 1})]
+    for i in range(0, len(uids), 10000):
+        chunk = uids[i:i + 10000]
+        odm.dispense('follower').collection.delete_many({'follower': {'$in': chunk}})
+        odm.dispense('blocked_user').collection.delete_many({'blocker': {'$in': chunk}})
+        _relations.counters_collection().delete_many({'_id': {'$in': chunk}})
+
+    users.delete_many({'login': {'$regex': '^' + PREFIX}})
+    odm.dispense('role').collection.delete_many({'name': {'$regex': '^' + PREFIX}})
+    _cache.misses.invalidate()
+    _role_registry.registry.bump_version()
+
+
+def seed(users_num: int, roles_num: int = 10, follows_per_user: int = 10, blocks_per_user: int = 1,
+         collisions: int = 100) -> Dict[str, List[str]]:
+    """Seed synthetic users, roles and relationships.
+
+    Documents are built from prototypes produced by ODM models and written directly. Returns UIDs of seeded users and
+    roles.
+    """
+    rnd = random.Random(users_num)
+
+    role_proto = _bulk.entity_to_doc(odm.dispense('role'))
+    role_uids = []
+
+    def roles_iter():
+        for i in range(roles_num):
+            oid = ObjectId()
+            uid = 'role:{}'.format(oid)
+            role_uids.append(uid)
+            yield dict(role_proto, _id=oid, _ref=uid, uid=uid, name='{}role-{}'.format(PREFIX, i),
+                       permissions=['{}permission-{}'.format(PREFIX, j) for j in range(i % 5)])
+
+    _insert(odm.dispense('role').collection, roles_iter())
+
+    password = auth.hash_password(PREFIX)
+    user_proto = _bulk.entity_to_doc(odm.dispense('user'))
+    user_uids = []
+
+    def users_iter():
+        for i in range(users_num + collisions):
+            oid = ObjectId()
+            uid = 'user:{}'.format(oid)
+            if i < users_num:
+                login = nickname = '{}user-{}'.format(PREFIX, i)
+                user_uids.append(uid)
+            else:
+                login = '{}collision-{}'.format(PREFIX, i)
+                nickname = _COLLIDING_NICKNAME + ('-{}'.format(i - users_num) if i > users_num else '')
+            doc = dict(user_proto, _id=oid, _ref=uid, uid=uid, login=login, nickname=nickname, password=password,
+                       first_name='First{}'.format(rnd.randrange(users_num)), last_name='Last{}'.format(i),
+                       last_activity=oid.generation_time.replace(tzinfo=None),
+                       roles=rnd.sample(role_uids, min(len(role_uids), 2)))
+            doc['autocomplete'] = _autocomplete.get_keys(doc)
+            yield doc
+
+    _insert(odm.dispense('user').collection, users_iter())
+
+    def edges_iter(model: str, own_field: str, other_field: str, per_user: int):
+        proto = _bulk.entity_to_doc(odm.dispense(model))
+        for uid in user_uids:
+            for other_uid in {rnd.choice(user_uids) for _ in range(per_user)} - {uid}:
+                oid = ObjectId()
+                yield dict(proto, _id=oid, _ref='{}:{}'.format(model, oid), **{own_field: uid, other_field: other_uid})
+
+    for model, own_field, other_field, per_user in (('follower', 'follower', 'follows', follows_per_user),
+                                                     ('blocked_user', 'blocker', 'blocked', blocks_per_user)):
+        _insert(odm.dispense(model).collection, edges_iter(model, own_field, other_field, per_user))
+
+    _cache.misses.invalidate()
+    _role_registry.registry.bump_version()
+    _relations.reconcile_counters(uids=user_uids)
+
+    return {'users': user_uids, 'roles': role_uids}
+
+
+def _op_counters() -> Dict[str, int]:
+    try:
+        return dict(mongodb.get_database().command('serverStatus')['opcounters'])
+    except Exception:
+        return {}
+
+
+def measure(name: str, func: Callable[..., None], iterations: int, prepare: Callable[[int], tuple] = None) -> dict:
+    """Run a function `iterations` times and collect throughput, latency, server operations and memory stats.
+
+    If `prepare` is given, arguments of each call are got from it before measurement, otherwise the function is called
+    with iteration number. Peak memory is measured in a separate pass, which is not timed.
+    """
+    args = [prepare(i) if prepare else (i,) for i in range(iterations)]
+
+    ops_before = _op_counters()
+    latencies = []
+    start = perf_counter()
+    for i in range(iterations):
+        _cache.users.clear()
+        t = perf_counter()
+        func(*args[i])
+        latencies.append(perf_counter() - t)
+    total = perf_counter() - start
+    ops_after = _op_counters()
+
+    # Tracing slows down allocations, so it is not enabled while timing
+    tracemalloc.start()
+    for i in range(min(iterations, 100)):
+        _cache.users.clear()
+        func(*args[i])
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    r = {
+        'name': name,
+        'iterations': iterations,
+        'throughput': iterations / max(total, 1e-9),
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'db_operations': {k: ops_after[k] - ops_before.get(k, 0) for k in ops_after
+                          if isinstance(ops_after[k], int) and ops_after[k] != ops_before.get(k, 0)},
+        'peak_memory_bytes': peak_memory,
+    }
+    console.print_info('{name}: {throughput:.1f} ops/s, p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms'.format(**r))
+
+    return r
+
+
+def run(users_num: int, iterations: int = 1000, page_size: int = 100) -> List[dict]:
+    """Run all benchmarks against seeded data
+    """
+    storage = auth.get_storage_driver()
+    rnd = random.Random(0)
+    users = odm.dispense('user').collection
+    q = {'login': {'$regex': '^' + PREFIX + 'user-'}}
+    docs = list(users.find(q, {'_id': 0, 'uid': 1, 'login': 1, 'nickname': 1}).limit(10000))
+    role_uids = [d['uid'] for d in odm.dispense('role').collection.find({'name': {'$regex': '^' + PREFIX}})]
+    if not docs:
+        raise RuntimeError('There is no seeded data')
+
+    def doc(i: int) -> dict:
+        return docs[rnd.randrange(len(docs))]
+
+    def deep_page(i: int):
+        # Walk pages using keyset tokens up to the same depth as skip() benchmark does
+        after = None
+        for _ in range(min(10, users_num // page_size)):
+            after = storage.find_users_page(sort=[('full_name', 1)], limit=page_size, after=after)[1]
+
+    results = [
+        measure('get_user.uid', lambda i: storage.get_user(uid=doc(i)['uid']), iterations),
+        measure('get_user.login', lambda i: storage.get_user(login=doc(i)['login']), iterations),
+        measure('get_user.nickname', lambda i: storage.get_user(nickname=doc(i)['nickname']), iterations),
+        measure('get_user.miss', lambda i: _safe_get_user(storage, PREFIX + 'missing-' + str(i)), iterations),
+        measure('count_users', lambda i: storage.count_users(), max(1, iterations // 100)),
+    ]
+
+    for sort_field in ('created', 'modified', 'is_online', 'full_name'):
+        results.append(measure('find_users.' + sort_field, lambda i, f=sort_field: list(
+            storage.find_users(sort=[(f, -1)], limit=page_size)), max(1, iterations // 10)))
+
+    deep_skip = max(0, min(users_num, 10 * page_size) - page_size)
+    results += [
+        measure('find_users.deep_skip', lambda i: list(
+            storage.find_users(sort=[('full_name', 1)], limit=page_size, skip=deep_skip)), max(1, iterations // 10)),
+        measure('find_users_page.deep_keyset', deep_page, max(1, iterations // 100)),
+        measure('field.users', lambda i: _field._get_users([doc(j)['uid'] for j in range(page_size)]),
+                max(1, iterations // 10)),
+        measure('field.roles', lambda i: _field._get_roles(role_uids), iterations),
+        measure('user.followers', lambda user: user.get_field('followers', count=page_size), iterations,
+                lambda i: (storage.get_user(uid=doc(i)['uid']),)),
+        measure('user.is_follows', lambda user, other: user.is_follows(other), iterations,
+                lambda i: (storage.get_user(uid=doc(i)['uid']), storage.get_user(uid=doc(i + 1)['uid']))),
+        measure('user.dispense', lambda i: odm.dispense('user'), iterations),
+        measure('user.dispense.uncached', lambda i: _dispense_uncached('user'), iterations),
+        measure('suggest_users', lambda i: storage.suggest_users(doc(i)['login'][:len(PREFIX) + 6]), iterations),
+        measure('user.sanitize_nickname', lambda i: odm.dispense('user')._sanitize_nickname(_COLLIDING_NICKNAME),
+                iterations),
+        measure('plugin_update.dry_run', lambda i: _migration.run(Version('3.2'), dry_run=True), 1),
+    ]
+
+    return results
+
+
+def _safe_get_user(storage, login: str):
+    try:
+        storage.get_user(login=login)
+    except auth.error.UserNotFound:
+        pass
+
+
+def _dispense_uncached(model: str) -> odm.model.Entity:
+    """Dispense an entity building its fields and indexes from scratch, as it was done before they were cached
+    """
+    _model._field_prototypes.clear()
+    _model._index_specs.clear()
+
+    return odm.dispense(model)
@@ -0,0 +1,134 @@
+"""PytSite Auth ODM Storage Bulk Operations
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterable, List, Tuple
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from pytsite import lang, reg, util
+from plugins import auth, odm
+from . import _autocomplete, _cache, _model
+
+
+def entity_to_doc(entity: odm.model.Entity) -> dict:
+    """Build a storable document from a new entity without saving it
+    """
+    doc = {}
+    for f_name, f in entity.fields.items():
+        if not isinstance(f, odm.field.Virtual):
+            doc[f_name] = f.get_storable_val()
+
+    oid = ObjectId()
+    now = datetime.now()
+    doc.update({
+        '_id': oid,
+        '_ref': '{}:{}'.format(entity.model, oid),
+        '_created': doc.get('_created') or now,
+        '_modified': doc.get('_modified') or now,
+    })
+
+    return doc
+
+
+def _insert_chunk(collection, docs: List[dict], indexes: List[int], ordered: bool,
+                  errors: Dict[int, str]) -> List[str]:
+    """Insert documents and return UIDs of inserted ones
+    """
+    try:
+        collection.insert_many(docs, ordered=ordered)
+        return [d['uid'] for d in docs]
+    except BulkWriteError as e:
+        failed = set()
+        for err in e.details.get('writeErrors', ()):
+            failed.add(err['index'])
+            errors[indexes[err['index']]] = err.get('errmsg', 'Write error')
+
+        if ordered:
+            return [d['uid'] for d in docs[:e.details.get('nInserted', 0)]]
+
+        return [d['uid'] for i, d in enumerate(docs) if i not in failed]
+
+
+def create_users(rows: Iterable[dict], chunk_size: int = None, ordered: bool = False,
+                 workers: int = None) -> Tuple[List[str], Dict[int, str]]:
+    """Create users from an iterable of field values dicts.
+
+    Passwords are hashed in a pool of processes, nicknames are resolved per chunk and users are written using
+    `insert_many()`. Entity hooks and events are not called. Returns UIDs of created users and error messages of failed
+    rows, indexed by row number. If `ordered` is True, creation stops at the first row which fails validation or
+    insertion.
+    """
+    chunk_size = chunk_size or reg.get('auth_storage_odm.bulk_chunk_size', 1000)
+    workers = workers or reg.get('auth_storage_odm.bulk_hash_workers')
+    collection = odm.dispense('user').collection
+    language = lang.get_current()
+    created = []
+    errors = {}
+    rows = enumerate(rows)
+
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            # Build documents from validated field values
+            docs = []
+            indexes = []
+            passwords = []
+            nicknames = []
+            for i, row in chunk:
+                row = dict(row)
+                password = row.pop('password', None) or util.random_password()
+                nickname = row.pop('nickname', None)
+                try:
+                    if not row.get('login'):
+                        raise ValueError('Login is not specified')
+
+                    entity = odm.dispense('user')
+                    entity.f_set_multiple(row)
+                    doc = entity_to_doc(entity)
+                    doc['uid'] = doc['_ref']
+                except Exception as e:
+                    errors[i] = str(e)
+                    if ordered:
+                        # Rows preceding the failed one are still created
+                        break
+                    continue
+
+                if not nickname:
+                    nickname = hashlib.md5(row['login'].encode('UTF-8')).hexdigest()
+
+                docs.append(doc)
+                indexes.append(i)
+                passwords.append(password)
+                nicknames.append(util.transform_str_2(nickname[:32], language))
+
+            if not docs:
+                if ordered and errors:
+                    break
+                continue
+
+            # Resolve unique nicknames with a single query per chunk
+            taken = _model._get_taken_nicknames(collection, nicknames)
+            for doc, nickname in zip(docs, nicknames):
+                doc['nickname'] = _model._next_free_nickname(nickname, taken)
+                doc['autocomplete'] = _autocomplete.get_keys(doc, language)
+                taken.add(doc['nickname'])
+
+            for doc, password_hash in zip(docs, pool.map(auth.hash_password, passwords, chunksize=64)):
+                doc['password'] = password_hash
+
+            created.extend(_insert_chunk(collection, docs, indexes, ordered, errors))
+            _cache.misses.invalidate()
+
+            if ordered and errors:
+                break
+
+    return created, errors
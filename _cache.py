@@ -0,0 +1,212 @@
+"""PytSite Auth ODM Storage Caches
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import threading as _threading
+import weakref as _weakref
+from collections import OrderedDict as _OrderedDict
+from time import monotonic as _monotonic
+from typing import Any, Hashable, Optional
+from pytsite import mongodb, reg
+
+_VERSIONS_COLLECTION = 'auth_storage_odm_versions'
+
+
+class VersionStamp:
+    """Version counter shared between processes through the database.
+
+    The counter is read from the database not more often than once per `auth_storage_odm.version_check_interval`
+    seconds, so processes notice each other's changes with that delay.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._value = None  # type: Optional[int]
+        self._checked = 0.0
+
+    def get(self) -> int:
+        """Get current version
+        """
+        if self._value is None or _monotonic() - self._checked >= reg.get('auth_storage_odm.version_check_interval',
+                                                                           1.0):
+            doc = mongodb.get_collection(_VERSIONS_COLLECTION).find_one({'_id': self._name})
+            self._value = doc['v'] if doc else 0
+            self._checked = _monotonic()
+
+        return self._value
+
+    def bump(self):
+        """Increment version
+        """
+        mongodb.get_collection(_VERSIONS_COLLECTION).update_one({'_id': self._name}, {'$inc': {'v': 1}}, upsert=True)
+        self._value = None
+
+
+class LRUCache:
+    """Thread safe LRU cache with optional per item TTL
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 0.0):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data = _OrderedDict()
+        self._lock = _threading.RLock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            value, expires = item
+            if expires and expires < _monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        if self._max_size <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (value, _monotonic() + self._ttl if self._ttl > 0 else 0.0)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def rm(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class UserIdentityMap:
+    """Per thread user identity map.
+
+    Users are stored by UID, logins and nicknames are secondary keys pointing to UIDs. Each thread gets its own bounded
+    map, which is cleared at the beginning of every HTTP request, so within a request a user is loaded from the database
+    only once. Writes invalidate the UID in all threads' maps.
+    """
+
+    def __init__(self):
+        self._local = _threading.local()
+        self._maps = _weakref.WeakSet()
+        self._maps_lock = _threading.Lock()
+
+    def _get_map(self) -> LRUCache:
+        m = getattr(self._local, 'map', None)
+        if m is None:
+            m = LRUCache(reg.get('auth_storage_odm.identity_map_size', 1000),
+                         reg.get('auth_storage_odm.identity_map_ttl', 10.0))
+            self._local.map = m
+            with self._maps_lock:
+                self._maps.add(m)
+
+        return m
+
+    def get(self, login: str = None, nickname: str = None, uid: str = None) -> Optional[Any]:
+        """Get a user by one of the keys
+        """
+        m = self._get_map()
+
+        if uid is None:
+            if login is not None:
+                uid = m.get(('login', login))
+            elif nickname is not None:
+                uid = m.get(('nickname', nickname))
+
+            if uid is None:
+                return None
+
+        user = m.get(('uid', uid))
+        if user is None:
+            return None
+
+        # Secondary keys may point to a UID whose login or nickname has been changed since
+        if (login is not None and user.login != login) or (nickname is not None and user.nickname != nickname):
+            return None
+
+        return user
+
+    def put(self, user):
+        """Put a user into the map of the current thread
+        """
+        m = self._get_map()
+        uid = user.uid
+        m.put(('uid', uid), user)
+        m.put(('login', user.login), uid)
+        m.put(('nickname', user.nickname), uid)
+
+    def rm(self, uid: str):
+        """Remove a user from maps of all threads
+        """
+        with self._maps_lock:
+            maps = list(self._maps)
+
+        for m in maps:
+            m.rm(('uid', uid))
+
+    def clear(self):
+        """Clear the map of the current thread
+        """
+        self._get_map().clear()
+
+
+users = UserIdentityMap()
+
+# Compiled role names and permissions, keyed by sorted role UIDs and role registry version
+role_sets = LRUCache(1000)
+
+
+class MissCache:
+    """Cache of failed user lookups.
+
+    Entries expire after `auth_storage_odm.miss_cache_ttl` seconds and are dropped at once when any process creates a
+    user.
+    """
+
+    def __init__(self):
+        self._cache = None  # type: Optional[LRUCache]
+        self._stamp = VersionStamp('user')
+
+    def _get_cache(self) -> LRUCache:
+        if self._cache is None:
+            self._cache = LRUCache(reg.get('auth_storage_odm.miss_cache_size', 10000),
+                                   reg.get('auth_storage_odm.miss_cache_ttl', 5.0))
+
+        return self._cache
+
+    def has(self, key: str, value: Any) -> bool:
+        """Check if a lookup by key is known to fail
+        """
+        return self._get_cache().get((key, value)) == self._stamp.get()
+
+    def put(self, key: str, value: Any):
+        """Remember failed lookup
+        """
+        self._get_cache().put((key, value), self._stamp.get())
+
+    def rm(self, key: str, value: Any):
+        """Forget failed lookup
+        """
+        self._get_cache().rm((key, value))
+
+    def invalidate(self):
+        """Forget failed lookups in all processes
+        """
+        self._stamp.bump()
+        self._get_cache().clear()
+
+
+misses = MissCache()
@@ -0,0 +1,214 @@
+"""PytSite Auth ODM Storage Console Commands
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import json
+from concurrent.futures import wait
+from pytsite import console
+from plugins import odm
+from semaver import Version
+from . import _bench, _migration, _picture, _relations, _transfer
+
+
+class FetchPictures(console.Command):
+    """Load missing users' pictures from Gravatar
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Int('batch', default=100))
+
+    @property
+    def name(self) -> str:
+        return 'auth_storage_odm:fetch_pictures'
+
+    @property
+    def description(self) -> str:
+        return 'auth_storage_odm@fetch_pictures_console_command_description'
+
+    def exec(self):
+        batch_size = self.opt('batch')
+        q = {'picture': {'$in': [None, '']}}
+        cursor = odm.dispense('user').collection.find(q, {'_id': 0, 'uid': 1}, batch_size=batch_size)
+
+        fetched = 0
+        futures = []
+        for d in cursor:
+            future = _picture.fetcher.enqueue(d['uid'])
+            if future:
+                futures.append(future)
+
+            if len(futures) >= batch_size:
+                fetched += sum(f.result() for f in wait(futures).done)
+                futures = []
+
+        fetched += sum(f.result() for f in wait(futures).done)
+
+        console.print_success('{} pictures fetched'.format(fetched))
+
+
+class Migrate(console.Command):
+    """Run plugin's data migrations
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Str('from', required=True))
+        self.define_option(console.option.Bool('dry-run'))
+        self.define_option(console.option.Bool('reset'))
+
+    @property
+    def name(self) -> str:
+        return 'auth_storage_odm:migrate'
+
+    @property
+    def description(self) -> str:
+        return 'auth_storage_odm@migrate_console_command_description'
+
+    def exec(self):
+        if self.opt('reset'):
+            _migration.reset()
+
+        _migration.run(Version(self.opt('from')), self.opt('dry-run'))
+
+
+class ReconcileCounters(console.Command):
+    """Recompute users' relationship counters
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Bool('dry-run'))
+
+    @property
+    def name(self) -> str:
+        return 'auth_storage_odm:reconcile_counters'
+
+    @property
+    def description(self) -> str:
+        return 'auth_storage_odm@reconcile_counters_console_command_description'
+
+    def exec(self):
+        _relations.reconcile_counters(self.opt('dry-run'))
+
+
+class SweepRelations(console.Command):
+    """Delete relationships which refer to non-existent users
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Bool('dry-run'))
+
+    @property
+    def name(self) -> str:
+        return 'auth_storage_odm:sweep_relations'
+
+    @property
+    def description(self) -> str:
+        return 'auth_storage_odm@sweep_relations_console_command_description'
+
+    def exec(self):
+        _relations.sweep_orphan_edges(self.opt('dry-run'))
+
+
+class Bench(console.Command):
+    """Benchmark storage hot paths
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Int('users', default=10000))
+        self.define_option(console.option.Int('roles', default=10))
+        self.define_option(console.option.Int('follows', default=10))
+        self.define_option(console.option.Int('iterations', default=1000))
+        self.define_option(console.option.Bool('seed'))
+        self.define_option(console.option.Bool('cleanup'))
+        self.define_option(console.option.Str('output'))
+
+    @property
+    def name(self) -> str:
+        return 'auth_storage_odm:bench'
+
+    @property
+    def description(self) -> str:
+        return 'auth_storage_odm@bench_console_command_description'
+
+    def exec(self):
+        users_num = self.opt('users')
+
+        if self.opt('seed'):
+            _bench.cleanup()
+            _bench.seed(users_num, self.opt('roles'), self.opt('follows'))
+
+        report = {
+            'users': users_num,
+            'roles': self.opt('roles'),
+            'follows': self.opt('follows'),
+            'results': _bench.run(users_num, self.opt('iterations')),
+        }
+
+        if self.opt('cleanup'):
+            _bench.cleanup()
+
+        output = json.dumps(report, indent=2)
+        if self.opt('output'):
+            with open(self.opt('output'), 'wt') as f:
+                f.write(output)
+        else:
+            console.print_normal(output)
+
+
+class Export(console.Command):
+    """Export users, roles and relationships to files
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Str('path', required=True))
+        self.define_option(console.option.Str('format', default='jsonl'))
+        self.define_option(console.option.Int('batch'))
+
+    @property
+    def name(self) -> str:
+        return 'auth_storage_odm:export'
+
+    @property
+    def description(self) -> str:
+        return 'auth_storage_odm@export_console_command_description'
+
+    def exec(self):
+        _transfer.export_data(self.opt('path'), self.opt('format'), batch_size=self.opt('batch'))
+
+
+class Import(console.Command):
+    """Import users, roles and relationships from files
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.define_option(console.option.Str('path', required=True))
+        self.define_option(console.option.Str('format', default='jsonl'))
+        self.define_option(console.option.Int('batch'))
+        self.define_option(console.option.Bool('no-validate'))
+
+    @property
+    def name(self) -> str:
+        return 'auth_storage_odm:import'
+
+    @property
+    def description(self) -> str:
+        return 'auth_storage_odm@import_console_command_description'
+
+    def exec(self):
+        _transfer.import_data(self.opt('path'), self.opt('format'), batch_size=self.opt('batch'),
+                              validate=not self.opt('no-validate'))
@@ -4,10 +4,13 @@ __author__ = 'Oleksandr Shepetko'
 __email__ = 'a@shepetko.com'
 __license__ = 'MIT'
 
-from typing import Iterator, List, Tuple
+import threading
+from time import monotonic
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from pytsite import logger, reg, util
 from plugins import auth, odm, query
-from . import _model
+from . import _autocomplete, _bulk, _cache, _metrics, _model, _pagination, _query, _relations, _role_registry, \
+    _snapshot
 
 _REG_ROLE_CLS = 'auth_storage_odm.role_class'
 _REG_USER_CLS = 'auth_storage_odm.user_class'
@@ -19,17 +22,23 @@ class Storage(auth.driver.Storage):
         if not issubclass(self._role_cls, _model.Role):
             raise TypeError("Subclass of {} expected, got {}. Please check the '{}' configuration parameter".
                             format(auth.AbstractRole, type(self._role_cls), _REG_ROLE_CLS))
+        self._cached_role_cls = _model.get_cached_role_cls(self._role_cls)
 
         self._user_cls = util.get_module_attr(reg.get(_REG_USER_CLS, 'plugins.auth_storage_odm.User'))
         if not issubclass(self._user_cls, _model.User):
             raise TypeError("Subclass of {} expected, got {}. Please check the '{}' configuration parameter".
                             format(auth.AbstractUser, type(self._user_cls), _REG_USER_CLS))
 
+        self._misses = 0
+        self._misses_logged = 0.0
+        self._misses_lock = threading.Lock()
+
     def get_name(self) -> str:
         """Get driver's name.
         """
         return 'odm'
 
+    @_metrics.timed('storage.create_role')
     def create_role(self, name: str, description: str = '') -> auth.AbstractRole:
         """Create a new role.
         """
@@ -38,29 +47,57 @@ class Storage(auth.driver.Storage):
 
         return self._role_cls(role_entity)
 
+    @_metrics.timed('storage.get_role', lookup=True)
     def get_role(self, name: str = None, uid: str = None) -> auth.AbstractRole:
-        f = odm.find('role')
+        """Get a role.
 
+        Role is served from the registry and loaded from the database on first modification.
+        """
         if name:
-            f.eq('name', name)
+            role_doc = _role_registry.registry.get(name=name)
         elif uid:
-            f.eq('uid', uid)
+            role_doc = _role_registry.registry.get(uid=uid)
         else:
             raise RuntimeError("Either role's name or UID must be specified")
 
-        role_entity = f.first()  # type: _model.ODMRole
-        if not role_entity:
+        if not role_doc:
             raise auth.error.RoleNotFound(name)
 
-        return self._role_cls(role_entity)
+        return self._cached_role_cls(role_doc)
+
+    @_metrics.timed('storage.get_roles')
+    def get_roles(self, uids: List[str]) -> List[auth.AbstractRole]:
+        """Get multiple roles by UIDs.
 
+        Roles are returned in the order of `uids`, non-existent ones are skipped.
+        """
+        return [self._cached_role_cls(role_doc) for role_doc in _role_registry.registry.get_many(uids)]
+
+    @_metrics.timed('storage.find_roles', lazy=True)
     def find_roles(self, query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
-                   skip: int = 0) -> Iterator[auth.AbstractRole]:
-        """Find roles
+                   skip: int = 0, read_only: bool = False) -> Iterator[auth.AbstractRole]:
+        """Find roles.
+
+        If `read_only` is True, lightweight read-only role snapshots are returned.
         """
+        if read_only:
+            return _snapshot.find_roles(_query.compile_query('role', query), sort, limit, skip, self._role_cls)
+
         # Return generator
         return (self._role_cls(role_entity) for role_entity in odm.find('role', query=query).skip(skip).get(limit))
 
+    @_metrics.timed('storage.find_roles_page')
+    def find_roles_page(self, query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 100,
+                        after: str = None) -> Tuple[List[auth.AbstractRole], Optional[str]]:
+        """Find a page of roles using keyset pagination.
+
+        Returns roles and an opaque token to pass as `after` to get the next page, or None if there are no more roles.
+        """
+        role_entities, next_token = _pagination.find_page('role', query, sort, limit, after)
+
+        return [self._role_cls(role_entity) for role_entity in role_entities], next_token
+
+    @_metrics.timed('storage.create_user')
     def create_user(self, login: str, password: str = None) -> auth.AbstractUser:
         user_entity = odm.dispense('user')  # type: _model.ODMUser
         user_entity.f_set_multiple({
@@ -70,48 +107,190 @@ class Storage(auth.driver.Storage):
 
         return self._user_cls(user_entity)
 
-    def get_user(self, login: str = None, nickname: str = None, uid: str = None) -> auth.AbstractUser:
-        # Don't cache finder results due to frequent user updates in database
-        f = odm.find('user').cache(0)
+    @_metrics.timed('storage.create_users')
+    def create_users(self, rows: Iterable[dict], ordered: bool = False) -> Tuple[List[str], Dict[int, str]]:
+        """Create users in bulk.
+
+        Each row is a dict of field values, it must contain at least 'login'. Returns UIDs of created users and error
+        messages of failed rows indexed by row number. If `ordered` is True, creation stops at the first failed row.
+        """
+        return _bulk.create_users(rows, ordered=ordered)
+
+    def _user_not_found(self, login: str = None, nickname: str = None, uid: str = None) -> auth.error.UserNotFound:
+        """Log a failed user lookup, not more often than once per `auth_storage_odm.miss_log_interval` seconds
+        """
+        with self._misses_lock:
+            self._misses += 1
+            now = monotonic()
+            if now - self._misses_logged >= reg.get('auth_storage_odm.miss_log_interval', 10.0):
+                logger.warn("User not exist: login={}, nickname={}, uid={}; {} failed lookups since last report".
+                            format(login, nickname, uid, self._misses))
+                self._misses = 0
+                self._misses_logged = now
+
+        # Hide exception details to logs
+        return auth.error.UserNotFound()
+
+    @_metrics.timed('storage.get_user', lookup=True)
+    def get_user(self, login: str = None, nickname: str = None, uid: str = None, fields: List[str] = None,
+                 read_only: bool = False) -> auth.AbstractUser:
+        """Get a user.
+
+        If `read_only` is True, a lightweight read-only user snapshot is returned. If `fields` is given, only these
+        fields are fetched into the snapshot.
+        """
         if login is not None:
-            f.eq('login', login)
+            key, value = 'login', login
         elif nickname is not None:
-            f.eq('nickname', nickname)
+            key, value = 'nickname', nickname
         elif uid is not None:
-            f.eq('uid', uid)
+            key, value = 'uid', uid
         else:
             raise RuntimeError('User search criteria was not specified')
 
-        user_entity = f.first()  # type: _model.ODMUser
+        # Lookup failed recently
+        if _cache.misses.has(key, value):
+            raise self._user_not_found(login, nickname, uid)
+
+        if fields or read_only:
+            for user in _snapshot.find_users({key: value}, fields, limit=1, user_cls=self._user_cls):
+                return user
+
+            _cache.misses.put(key, value)
+            raise self._user_not_found(login, nickname, uid)
+
+        # Users loaded earlier during the current request
+        user = _cache.users.get(login, nickname, uid)
+        if user:
+            return user
+
+        # Don't cache finder results due to frequent user updates in database
+        user_entity = odm.find('user').cache(0).eq(key, value).first()  # type: _model.ODMUser
         if not user_entity:
-            # Hide exception details to logs
-            logger.warn("User not exist: login={}, nickname={}, uid={}".format(login, nickname, uid))
-            raise auth.error.UserNotFound()
+            _cache.misses.put(key, value)
+            raise self._user_not_found(login, nickname, uid)
 
-        return self._user_cls(user_entity)
+        user = self._user_cls(user_entity)
+        _cache.users.put(user)
+
+        return user
 
+    @_metrics.timed('storage.get_users')
+    def get_users(self, uids: List[str]) -> List[auth.AbstractUser]:
+        """Get multiple users by UIDs using single query.
+
+        Users are returned in the order of `uids`, non-existent ones are skipped.
+        """
+        if not uids:
+            return []
+
+        users = {}
+        for uid in uids:
+            user = _cache.users.get(uid=uid)
+            if user:
+                users[uid] = user
+
+        to_load = list(set(uids) - set(users))
+        if to_load:
+            for user_entity in odm.find('user').cache(0).inc('uid', to_load).get():
+                user = self._user_cls(user_entity)
+                _cache.users.put(user)
+                users[user.uid] = user
+
+        return [users[uid] for uid in uids if uid in users]
+
+    @staticmethod
+    def _get_users_sort(sort: List[Tuple[str, int]] = None) -> List[Tuple[str, int]]:
+        r = []
+        for sort_field, sort_order in sort or ():
+            if sort_field in _relations.COUNTERS:
+                raise ValueError("Users cannot be sorted by '{}', it is not stored in users' documents".
+                                 format(sort_field))
+            elif sort_field in ('created', 'modified'):
+                sort_field = '_' + sort_field
+            elif sort_field == 'full_name':
+                sort_field = 'first_name'
+            elif sort_field == 'is_online':
+                sort_field = 'last_activity'
+
+            r.append((sort_field, sort_order))
+
+        return r
+
+    @_metrics.timed('storage.find_users', lazy=True)
     def find_users(self, query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = None,
-                   skip: int = 0) -> Iterator[auth.AbstractUser]:
-        """Find users
+                   skip: int = 0, fields: List[str] = None, read_only: bool = False) -> Iterator[auth.AbstractUser]:
+        """Find users.
+
+        If `read_only` is True, lightweight read-only user snapshots are returned. If `fields` is given, only these
+        fields are fetched into snapshots.
         """
-        f = odm.find('user', query=query).skip(skip)
+        if fields or read_only:
+            return _snapshot.find_users(_query.compile_query('user', query), fields, self._get_users_sort(sort),
+                                        limit, skip, self._user_cls)
 
-        if sort:
-            for sort_field, sort_order in sort:
-                if sort_field in ('created', 'modified'):
-                    sort_field = '_' + sort_field
-                elif sort_field == 'full_name':
-                    sort_field = 'first_name'
-                elif sort_field == 'is_online':
-                    sort_field = 'last_activity'
+        f = odm.find('user', query=query).skip(skip)
 
-                f.sort([(sort_field, sort_order)])
+        for sort_field, sort_order in self._get_users_sort(sort):
+            f.sort([(sort_field, sort_order)])
 
         # Return generator
         return (self._user_cls(user_entity) for user_entity in f.get(limit))
 
+    @_metrics.timed('storage.find_users_page')
+    def find_users_page(self, query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 100,
+                        after: str = None) -> Tuple[List[auth.AbstractUser], Optional[str]]:
+        """Find a page of users using keyset pagination.
+
+        Returns users and an opaque token to pass as `after` to get the next page, or None if there are no more users.
+        """
+        user_entities, next_token = _pagination.find_page('user', query, self._get_users_sort(sort), limit, after)
+
+        return [self._user_cls(user_entity) for user_entity in user_entities], next_token
+
+    @_metrics.timed('storage.suggest_users')
+    def suggest_users(self, prefix: str, limit: int = 10, fields: List[str] = None) -> List[auth.AbstractUser]:
+        """Find users whose login, nickname, first or last name starts with a prefix.
+
+        Returns read-only user snapshots, `fields` limits fields fetched into them.
+        """
+        q = _autocomplete.get_query(prefix)
+        if not q:
+            return []
+
+        return list(_snapshot.find_users(q, fields, limit=limit, user_cls=self._user_cls))
+
+    @_metrics.timed('storage.count_users')
     def count_users(self, query: query.Query = None) -> int:
         return odm.find('user', query=query).count()
 
+    @_metrics.timed('storage.count_users_by_role')
+    def count_users_by_role(self) -> Dict[str, int]:
+        """Count users of every role using single aggregation.
+
+        Returns numbers of users by role names.
+        """
+        pipeline = [
+            {'$unwind': '$roles'},
+            {'$group': {'_id': '$roles', 'count': {'$sum': 1}}},
+        ]
+        counts = {d['_id']: d['count'] for d in odm.dispense('user').collection.aggregate(pipeline)}
+
+        return {r['name']: counts.get(r['uid'], 0) for r in _role_registry.registry.get_all()}
+
+    @_metrics.timed('storage.find_users_in_role', lazy=True)
+    def find_users_in_role(self, role: Union[auth.AbstractRole, str], sort: List[Tuple[str, int]] = None,
+                           limit: int = None, skip: int = 0, fields: List[str] = None) -> Iterator[auth.AbstractUser]:
+        """Find users having a role, given as a role object or name.
+
+        Users are streamed as read-only snapshots, `fields` limits fields fetched into them.
+        """
+        if isinstance(role, str):
+            role = self.get_role(role)
+
+        return _snapshot.find_users({'roles': role.uid}, fields, self._get_users_sort(sort), limit, skip,
+                                    self._user_cls)
+
+    @_metrics.timed('storage.count_roles')
     def count_roles(self, query: query.Query = None) -> int:
         return odm.find('role', query=query).count()
@@ -0,0 +1,15 @@
+"""PytSite Auth ODM Storage Event Handlers
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from . import _cache, _metrics
+
+
+def router_dispatch():
+    """pytsite.router.dispatch
+    """
+    # Users loaded during previous request must not leak into the current one
+    _cache.users.clear()
+    _metrics.reset_request()
@@ -7,6 +7,7 @@ __license__ = 'MIT'
 from bson import DBRef
 from typing import Dict, List, Optional, Union, Any
 from plugins import auth, odm
+from . import _metrics
 
 
 def _resolve_user(allow_system: bool, allow_anonymous: bool, disallowed_users: List[auth.AbstractUser],
@@ -16,9 +17,11 @@ def _resolve_user(allow_system: bool, allow_anonymous: bool, disallowed_users: L
     if isinstance(value, auth.AbstractUser):
         user = value
     elif isinstance(value, str):
-        user = auth.get_user(uid=value)
+        with _metrics.measure('field.resolve_user', value):
+            user = auth.get_user(uid=value)
     elif isinstance(value, DBRef):
-        user = auth.get_user(uid=value.id)
+        with _metrics.measure('field.resolve_user', value.id):
+            user = auth.get_user(uid=value.id)
     else:
         raise TypeError("User object, str or DB ref expected, got {}".format(type(value)))
 
@@ -35,6 +38,25 @@ def _resolve_user(allow_system: bool, allow_anonymous: bool, disallowed_users: L
     return user
 
 
+def _get_users(uids: List[str]) -> List[auth.AbstractUser]:
+    """Helper
+    """
+    # Users not found by the storage driver, i. e. anonymous, system or non-existent, are resolved one by one
+    with _metrics.measure('field.get_users'):
+        found = {u.uid: u for u in auth.get_storage_driver().get_users(uids)}
+
+    return [found[uid] if uid in found else auth.get_user(uid=uid) for uid in uids]
+
+
+def _get_roles(uids: List[str]) -> List[auth.AbstractRole]:
+    """Helper
+    """
+    with _metrics.measure('field.get_roles'):
+        found = {r.uid: r for r in auth.get_storage_driver().get_roles(uids)}
+
+    return [found[uid] if uid in found else auth.get_role(uid=uid) for uid in uids]
+
+
 class Roles(odm.field.UniqueList):
     def __init__(self, name: str, **kwargs):
         super().__init__(name, allowed_types=(auth.model.AbstractRole,), **kwargs)
@@ -45,9 +67,11 @@ class Roles(odm.field.UniqueList):
         if isinstance(value, auth.model.AbstractRole):
             return value
         elif isinstance(value, str):
-            return auth.get_role(uid=value)
+            with _metrics.measure('field.resolve_role', value):
+                return auth.get_role(uid=value)
         elif isinstance(value, DBRef):
-            return auth.get_role(uid=str(value.id))
+            with _metrics.measure('field.resolve_role', value.id):
+                return auth.get_role(uid=str(value.id))
         else:
             raise TypeError("Field '{}': role object, str or DB ref expected, got {}".format(self.name, type(value)))
 
@@ -65,7 +89,7 @@ class Roles(odm.field.UniqueList):
     def _on_get(self, value: List[str], **kwargs) -> List[auth.AbstractRole]:
         """Hook
         """
-        return [auth.get_role(uid=v) for v in value]
+        return _get_roles(list(value))
 
     def _on_add(self, current_value: tuple, raw_value_to_add, **kwargs):
         """Hook
@@ -173,7 +197,7 @@ class Users(odm.field.UniqueList):
     def _on_get(self, value: List[str], **kwargs) -> List[auth.AbstractUser]:
         """Hook
         """
-        return [auth.get_user(uid=uid) for uid in value]
+        return _get_users(list(value))
 
     def _on_add(self, current_value: tuple, raw_value_to_add: Any, **kwargs):
         """Hook
@@ -220,7 +244,7 @@ class UsersDict(odm.field.Dict):
     def _on_get(self, value: Dict[str, str], **kwargs) -> Dict[Any, auth.AbstractUser]:
         """Hook
         """
-        return {k: auth.get_user(uid=v) for k, v in value.items()}
+        return dict(zip(value.keys(), _get_users(list(value.values()))))
 
 
 class UsersDictReversed(UsersDict):
@@ -239,4 +263,4 @@ class UsersDictReversed(UsersDict):
         return clean_value
 
     def _on_get(self, value: dict, **kwargs) -> Dict[auth.AbstractUser, Any]:
-        return {auth.get_user(uid=k): v for k, v in value.items()}
+        return dict(zip(_get_users(list(value.keys())), value.values()))
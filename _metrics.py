@@ -0,0 +1,133 @@
+"""PytSite Auth ODM Storage Metrics
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import threading as _threading
+from bisect import bisect_left as _bisect_left
+from contextlib import contextmanager as _contextmanager
+from functools import wraps as _wraps
+from time import perf_counter as _perf_counter
+from typing import Callable, Dict, Hashable, Iterable, Iterator
+from pytsite import events, logger, reg
+
+# Upper bounds of timing histogram buckets, milliseconds
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf'))
+
+_stats = {}  # type: Dict[str, dict]
+_stats_lock = _threading.Lock()
+_request = _threading.local()
+
+
+def _record(name: str, duration: float):
+    with _stats_lock:
+        s = _stats.get(name)
+        if s is None:
+            s = _stats[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * len(BUCKETS)}
+
+        ms = duration * 1000
+        s['count'] += 1
+        s['total_ms'] += ms
+        s['max_ms'] = max(s['max_ms'], ms)
+        s['buckets'][_bisect_left(BUCKETS, ms)] += 1
+
+
+def _check_repeat(name: str, key: Hashable):
+    """Warn if the same lookup is repeated too many times during a request
+    """
+    lookups = getattr(_request, 'lookups', None)
+    if lookups is None or len(lookups) >= reg.get('auth_storage_odm.repeated_lookup_max_keys', 10000):
+        # Threads which do not serve requests are never reset, so the map is bounded
+        lookups = _request.lookups = {}
+
+    n = lookups[(name, key)] = lookups.get((name, key), 0) + 1
+    if n == reg.get('auth_storage_odm.repeated_lookup_threshold', 5):
+        logger.warn('Possible N+1 problem: {}{} called {} times during single request'.format(name, key, n))
+        events.fire('auth_storage_odm@repeated_lookup', name=name, key=key, count=n)
+
+
+@_contextmanager
+def measure(name: str, key: Hashable = None):
+    """Count and time a block of code.
+
+    If `key` is given, it is used to detect repeated lookups.
+    """
+    if key is not None:
+        _check_repeat(name, key)
+
+    start = _perf_counter()
+    try:
+        yield
+    finally:
+        _emit(name, _perf_counter() - start)
+
+
+def _emit(name: str, duration: float):
+    _record(name, duration)
+    events.fire('auth_storage_odm@metric', name=name, duration=duration)
+
+
+def _measure_iter(name: str, iterable: Iterable, duration: float) -> Iterator:
+    """Iterate over an iterable adding time spent to get its items to `duration`, which is recorded at the end
+    """
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = _perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                duration += _perf_counter() - start
+
+            yield item
+    finally:
+        _emit(name, duration)
+
+
+def timed(name: str, lookup: bool = False, lazy: bool = False) -> Callable:
+    """Decorator to count and time calls of a method.
+
+    If `lookup` is True, method's arguments are used to detect repeated lookups. If `lazy` is True, the method returns
+    an iterator and time spent to iterate over it is included.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @_wraps(func)
+        def wrapper(*args, **kwargs):
+            if lookup:
+                _check_repeat(name, repr((args[1:], kwargs)))
+
+            if lazy:
+                start = _perf_counter()
+                r = func(*args, **kwargs)
+                return _measure_iter(name, r, _perf_counter() - start)
+
+            with measure(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_stats() -> Dict[str, dict]:
+    """Get collected stats
+    """
+    with _stats_lock:
+        return {k: dict(v, buckets=list(v['buckets'])) for k, v in _stats.items()}
+
+
+def reset():
+    """Reset collected stats
+    """
+    with _stats_lock:
+        _stats.clear()
+
+
+def reset_request():
+    """Forget lookups made during current request
+    """
+    _request.lookups = {}
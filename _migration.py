@@ -0,0 +1,171 @@
+"""PytSite Auth ODM Storage Migrations
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import re
+from typing import Callable, Dict, Optional, Tuple
+from pymongo import UpdateOne
+from pytsite import console, mongodb, reg
+from plugins import odm
+from semaver import Version
+from . import _autocomplete, _field, _model, _relations
+
+_CHECKPOINTS_COLLECTION = 'auth_storage_odm_migrations'
+_DB_OBJ_ID_RE = re.compile('[a-z:]+([0-9a-f]{24})$')
+
+
+def _checkpoints():
+    return mongodb.get_collection(_CHECKPOINTS_COLLECTION)
+
+
+def reset():
+    """Forget progress of all migration steps
+    """
+    _checkpoints().delete_many({})
+
+
+def update_documents(step: str, collection, projection: dict, transform: Callable[[dict], Optional[dict]],
+                     query: dict = None, dry_run: bool = False) -> Tuple[int, int]:
+    """Update documents of a collection in chunks.
+
+    Documents are scanned once in `_id` order, `transform` returns a dict of values to set or None. Progress is stored
+    after each chunk, so an interrupted step continues from the last written document. Returns numbers of scanned and
+    updated documents.
+    """
+    checkpoint = _checkpoints().find_one({'_id': step}) or {}
+    if checkpoint.get('done') and not dry_run:
+        return 0, 0
+
+    chunk_size = reg.get('auth_storage_odm.migration_chunk_size', 1000)
+    q = dict(query or {})
+    if checkpoint.get('last_id') and not dry_run:
+        q['_id'] = {'$gt': checkpoint['last_id']}
+
+    scanned = updated = 0
+    requests = []
+    last_id = None
+
+    def flush():
+        if requests and not dry_run:
+            collection.bulk_write(requests, ordered=False)
+        if last_id is not None and not dry_run:
+            _checkpoints().update_one({'_id': step}, {'$set': {'last_id': last_id}}, upsert=True)
+        requests.clear()
+
+    for d in collection.find(q, projection, batch_size=chunk_size).sort('_id', 1):
+        scanned += 1
+        last_id = d['_id']
+
+        values = transform(d)
+        if values:
+            updated += 1
+            requests.append(UpdateOne({'_id': d['_id']}, {'$set': values}))
+
+        if scanned % chunk_size == 0:
+            flush()
+            console.print_info('{}: {} documents scanned, {} updated'.format(step, scanned, updated))
+
+    flush()
+    if not dry_run:
+        _checkpoints().update_one({'_id': step}, {'$set': {'done': True}}, upsert=True)
+
+    console.print_info('{}: {} documents scanned, {} {}updated'.format(step, scanned, updated,
+                                                                        'to be ' if dry_run else ''))
+
+    return scanned, updated
+
+
+def _get_ref_fields(mock: odm.model.Entity) -> Dict[str, odm.field.Base]:
+    return {f_name: f for f_name, f in mock.fields.items() if isinstance(f, (_field.User, _field.Users, _field.Roles))}
+
+
+def _convert_refs(ref_fields: Dict[str, odm.field.Base], d: dict) -> Optional[dict]:
+    values = {}
+    for f_name, f in ref_fields.items():
+        if not d.get(f_name):
+            continue
+
+        if isinstance(f, _field.User):
+            values[f_name] = '{}:{}'.format('user', _DB_OBJ_ID_RE.sub('\\1', d[f_name]))
+        else:
+            auth_model = 'role' if isinstance(f, _field.Roles) else 'user'
+            values[f_name] = ['{}:{}'.format(auth_model, _DB_OBJ_ID_RE.sub('\\1', v)) for v in d[f_name]]
+
+    return values or None
+
+
+def run(v_from: Version, dry_run: bool = False):
+    """Run migration steps required to update from a version
+    """
+    if v_from <= '2.3':
+        # Field 'uid' added to users and roles
+        for c in ('users', 'roles'):
+            update_documents('2.3:' + c, mongodb.get_collection(c), {'_id': 1}, lambda d: {'uid': str(d['_id'])},
+                             dry_run=dry_run)
+
+        if not dry_run:
+            odm.clear_cache('role')
+            odm.clear_cache('user')
+            odm.reindex('role')
+            odm.reindex('user')
+
+    if v_from <= '3.2':
+        # Format of users and roles UIDs changed
+        for c in ('users', 'roles'):
+            update_documents('3.2:' + c, mongodb.get_collection(c), {'_ref': 1}, lambda d: {'uid': d['_ref']},
+                             dry_run=dry_run)
+
+        if not dry_run:
+            odm.clear_cache('role')
+            odm.clear_cache('user')
+            odm.reindex('role')
+            odm.reindex('user')
+
+        # References to users and roles, all fields of a model are converted during single scan
+        for m in odm.get_registered_models():
+            mock = odm.dispense(m)
+            ref_fields = _get_ref_fields(mock)
+            if not ref_fields:
+                continue
+
+            projection = {f_name: 1 for f_name in ref_fields}
+            update_documents('3.2:refs:' + m, mock.collection, projection,
+                             lambda d, fields=ref_fields: _convert_refs(fields, d), dry_run=dry_run)
+
+            if not dry_run:
+                odm.clear_cache(m)
+
+    if v_from <= '3.4' and not dry_run:
+        odm.reindex('role')
+        odm.reindex('user')
+
+    if v_from < '5.0':
+        # Users' autocomplete keys
+        update_documents('5.0:autocomplete', odm.dispense('user').collection,
+                         {f: 1 for f in _autocomplete.FIELDS}, lambda d: {'autocomplete': _autocomplete.get_keys(d)},
+                         dry_run=dry_run)
+
+    if v_from < '5.0' and not dry_run:
+        # Relationship indexes in reverse direction, built without blocking collections
+        for m, keys in _model.REVERSE_INDEXES.items():
+            console.print_info("Building index {} of '{}' model".format(keys, m))
+            odm.dispense(m).collection.create_index(keys, background=True)
+
+        for keys in ([('autocomplete', odm.I_ASC)], [('roles', odm.I_ASC)]):
+            console.print_info("Building index {} of 'user' model".format(keys))
+            odm.dispense('user').collection.create_index(keys, background=True)
+
+        # Relationship counters are maintained since 5.0
+        _relations.reconcile_counters()
+
+    if v_from < '5.0':
+        # Relationship counters moved out of users' documents
+        q = {'$or': [{c: {'$exists': True}} for c in _relations.COUNTERS]}
+        users = odm.dispense('user').collection
+        if dry_run:
+            n = users.count_documents(q)
+        else:
+            n = users.update_many(q, {'$unset': {c: '' for c in _relations.COUNTERS}}).modified_count
+        console.print_info('5.0:counters: stale counters of {} users {}removed'.format(n, 'to be ' if dry_run else ''))
@@ -4,23 +4,80 @@ __author__ = 'Oleksandr Shepetko'
 __email__ = 'a@shepetko.com'
 __license__ = 'MIT'
 
+import copy
 import hashlib
-from pytsite import util, lang
-from plugins import auth, file_storage_odm, file, odm
-from . import _field
+import re
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from pytsite import util, lang, reg
+from plugins import auth, file_storage_odm, odm
+from . import _activity, _autocomplete, _cache, _field, _metrics, _pagination, _picture, _relations, _role_registry
+
+
+# Fields built once per entity class
+_field_prototypes = {}  # type: Dict[type, List[odm.field.Base]]
+
+# Indexes specs built once per entity class: (specs, whether there is a text index)
+_index_specs = {}  # type: Dict[type, Tuple[tuple, bool]]
+
+
+def _clone_field(prototype: odm.field.Base) -> odm.field.Base:
+    """Make a copy of a field which shares nothing mutable with the prototype
+    """
+    f = copy.copy(prototype)
+    for k, v in vars(f).items():
+        if isinstance(v, (list, dict, set)):
+            setattr(f, k, copy.copy(v))
+
+    return f
+
+
+def _define_fields(entity: odm.model.Entity):
+    """Define entity's fields by copying prototypes built by its class' `_build_fields()` method
+    """
+    prototypes = _field_prototypes.get(type(entity))
+    if prototypes is None:
+        prototypes = _field_prototypes[type(entity)] = entity._build_fields()
+
+    for f in prototypes:
+        entity.define_field(_clone_field(f))
+
+
+def _define_indexes(entity: odm.model.Entity):
+    """Define entity's indexes, they are built and validated by its class' `_build_indexes()` method only once
+    """
+    specs = _index_specs.get(type(entity))
+    if specs is None:
+        n = len(entity.indexes)
+        entity._build_indexes()
+        _index_specs[type(entity)] = (tuple(entity.indexes[n:]), entity.has_text_index)
+        return
+
+    entity.indexes.extend(specs[0])
+    if specs[1]:
+        entity._has_text_index = True
 
 
 class ODMRole(odm.model.Entity):
+    @classmethod
+    def _build_fields(cls) -> List[odm.field.Base]:
+        """Build fields prototypes
+        """
+        return [
+            odm.field.String('uid'),
+            odm.field.String('name'),
+            odm.field.String('description'),
+            odm.field.UniqueStringList('permissions'),
+        ]
+
     def _setup_fields(self):
         """Hook
         """
-        self.define_field(odm.field.String('uid'))
-        self.define_field(odm.field.String('name'))
-        self.define_field(odm.field.String('description'))
-        self.define_field(odm.field.UniqueStringList('permissions'))
+        _define_fields(self)
 
-    def _setup_indexes(self):
-        """Hook
+    def _build_indexes(self):
+        """Define indexes, called once per class
         """
         self.define_index([('uid', odm.I_ASC)], unique=True)
         self.define_index([('name', odm.I_ASC)], unique=True)
@@ -29,12 +86,31 @@ class ODMRole(odm.model.Entity):
             ('description', odm.I_TEXT),
         ], name='text_index')
 
+    def _setup_indexes(self):
+        """Hook
+        """
+        _define_indexes(self)
+
     def _on_pre_save(self, **kwargs):
         super()._on_pre_save(**kwargs)
 
         if self.is_new:
             self.f_set('uid', self.ref)
 
+    def _on_after_save(self, first_save: bool = False, **kwargs):
+        """Hook
+        """
+        super()._on_after_save(first_save, **kwargs)
+
+        _role_registry.registry.bump_version()
+
+    def _on_after_delete(self, **kwargs):
+        """Hook
+        """
+        super()._on_after_delete(**kwargs)
+
+        _role_registry.registry.bump_version()
+
 
 class Role(auth.model.AbstractRole):
     def __init__(self, odm_entity: ODMRole):
@@ -87,9 +163,148 @@ class Role(auth.model.AbstractRole):
         self._entity.delete()
 
 
+class _RoleDoc:
+    """Read-only stand-in of a role entity which serves fields from a stored document
+    """
+
+    def __init__(self, doc: dict):
+        self._doc = doc
+
+    @property
+    def is_new(self) -> bool:
+        return False
+
+    @property
+    def is_modified(self) -> bool:
+        return False
+
+    def has_field(self, field_name: str) -> bool:
+        return field_name in self._doc
+
+    def f_get(self, field_name: str, **kwargs):
+        value = self._doc.get(field_name)
+
+        # Document is shared, so mutable values are copied
+        return copy.copy(value) if isinstance(value, (list, dict)) else value
+
+
+class CachedRole:
+    """Mixin which makes a role class serve a shared role document, the entity is loaded on first modification.
+
+    Classes are built per role class by `get_cached_role_cls()`. Role's `__init__()` is not called.
+    """
+
+    def __init__(self, doc: dict):
+        self._doc = _RoleDoc(doc)
+        self._loaded_entity = None  # type: Optional[ODMRole]
+
+    @property
+    def _entity(self):
+        return self._loaded_entity or self._doc
+
+    def _load_entity(self) -> ODMRole:
+        if self._loaded_entity is None:
+            entity = odm.find('role').cache(0).eq('_id', self._doc.f_get('_id')).first()
+            if not entity:
+                raise auth.error.RoleNotFound(self._doc.f_get('name'))
+            self._loaded_entity = entity
+
+        return self._loaded_entity
+
+    @property
+    def odm_entity(self) -> ODMRole:
+        return self._load_entity()
+
+    def set_field(self, field_name: str, value):
+        self._load_entity()
+
+        return super().set_field(field_name, value)
+
+    def add_to_field(self, field_name: str, value):
+        self._load_entity()
+
+        return super().add_to_field(field_name, value)
+
+    def sub_from_field(self, field_name: str, value):
+        self._load_entity()
+
+        return super().sub_from_field(field_name, value)
+
+    def do_save(self):
+        self._load_entity()
+        super().do_save()
+
+    def do_delete(self):
+        self._load_entity()
+        super().do_delete()
+
+
+# Cached role classes, indexed by role classes
+_cached_role_classes = {}  # type: Dict[type, type]
+
+
+def get_cached_role_cls(role_cls: type) -> type:
+    """Get subclass of a role class which serves shared role documents
+    """
+    cls = _cached_role_classes.get(role_cls)
+    if cls is None:
+        cls = _cached_role_classes[role_cls] = type('Cached' + role_cls.__name__, (CachedRole, role_cls), {})
+
+    return cls
+
+
+def _get_taken_nicknames(collection, bases: Iterable[str], exclude_id: ObjectId = None) -> Set[str]:
+    """Get existing nicknames equal to any of `bases` or to any of them with a numeric suffix
+    """
+    # Anchored regular expressions are resolved by the 'nickname' index ranges
+    q = {'nickname': {'$in': [re.compile('^' + re.escape(b) + '(-[0-9]+)?$') for b in set(bases)]}}
+    if exclude_id:
+        q['_id'] = {'$ne': exclude_id}
+
+    return {d['nickname'] for d in collection.find(q, {'_id': 0, 'nickname': 1})}
+
+
+def _next_free_nickname(base: str, taken: Set[str]) -> str:
+    """Get first nickname from sequence `base`, `base-1`, `base-2`, ... which is not taken
+    """
+    nickname = base
+    cnt = 0
+    while nickname in taken:
+        cnt += 1
+        nickname = base + '-' + str(cnt)
+
+    return nickname
+
+
+class _ActivityPreservingCollection:
+    """Collection which replaces documents keeping their stored activity fields
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name: str):
+        return getattr(self._collection, name)
+
+    def replace_one(self, filter: dict, replacement: dict, *args, **kwargs):
+        fields = {k: v for k, v in replacement.items() if k != '_id' and k not in _activity.FIELDS}
+
+        return self._collection.update_one(filter, {'$set': fields}, *args, **kwargs)
+
+
 class ODMUser(odm.model.Entity):
     """ODM model to store information about user
     """
+    # Whether to keep stored activity fields on save, see User.do_save()
+    _skip_activity_fields = False
+
+    @property
+    def collection(self):
+        """Get entity's collection
+        """
+        collection = super().collection
+
+        return _ActivityPreservingCollection(collection) if self._skip_activity_fields else collection
 
     @classmethod
     def odm_auth_permissions_group(cls) -> str:
@@ -97,77 +312,82 @@ class ODMUser(odm.model.Entity):
         """
         return 'security'
 
+    @classmethod
+    def _build_fields(cls) -> List[odm.field.Base]:
+        """Build fields prototypes
+        """
+        return [
+            odm.field.String('uid', is_required=True),
+            odm.field.String('login', is_required=True, max_length=auth.LOGIN_MAX_LENGTH),
+            odm.field.String('nickname', is_required=True, max_length=auth.NICKNAME_MAX_LENGTH),
+            odm.field.String('password', is_required=True),
+            odm.field.String('confirmation_hash'),
+            odm.field.Bool('is_public'),
+            odm.field.Virtual('is_confirmed'),
+            odm.field.String('first_name', max_length=auth.FIRST_NAME_MAX_LENGTH),
+            odm.field.String('middle_name', max_length=auth.MIDDLE_NAME_MAX_LENGTH),
+            odm.field.String('last_name', max_length=auth.LAST_NAME_MAX_LENGTH),
+            odm.field.String('position', max_length=auth.USER_POSITION_MAX_LENGTH),
+            odm.field.String('description', max_length=auth.USER_DESCRIPTION_MAX_LENGTH),
+            odm.field.DateTime('birth_date'),
+            odm.field.String('timezone'),
+            odm.field.DateTime('last_sign_in'),
+            odm.field.DateTime('last_activity'),
+            odm.field.Integer('sign_in_count'),
+            odm.field.String('status', default='active'),
+            _field.Roles('roles'),
+            odm.field.Enum('gender', values=('m', 'f')),
+            odm.field.String('phone', max_length=auth.PHONE_MAX_LENGTH),
+            odm.field.Dict('options'),
+            file_storage_odm.field.Image('picture'),
+            file_storage_odm.field.Image('cover_picture'),
+            odm.field.UniqueStringList('urls'),
+            odm.field.String('last_ip'),
+            odm.field.String('country', max_length=auth.COUNTRY_MAX_LENGTH),
+            odm.field.String('province', max_length=auth.PROVINCE_MAX_LENGTH),
+            odm.field.String('city', max_length=auth.CITY_MAX_LENGTH),
+            odm.field.String('district', max_length=auth.DISTRICT_MAX_LENGTH),
+            odm.field.String('street', max_length=auth.STREET_MAX_LENGTH),
+            odm.field.String('building', max_length=auth.BUILDING_MAX_LENGTH),
+            odm.field.String('apt_number', max_length=auth.APT_NUMBER_MAX_LENGTH),
+            odm.field.String('postal_code', max_length=auth.POSTAL_CODE_MAX_LENGTH),
+            odm.field.UniqueStringList('autocomplete'),
+        ]
+
     def _setup_fields(self):
         """Hook
         """
-        # Fields
-        self.define_field(odm.field.String('uid', is_required=True))
-        self.define_field(odm.field.String('login', is_required=True, max_length=auth.LOGIN_MAX_LENGTH))
-        self.define_field(odm.field.String('nickname', is_required=True, max_length=auth.NICKNAME_MAX_LENGTH))
-        self.define_field(odm.field.String('password', is_required=True))
-        self.define_field(odm.field.String('confirmation_hash'))
-        self.define_field(odm.field.Bool('is_public'))
-        self.define_field(odm.field.Virtual('is_confirmed'))
-        self.define_field(odm.field.String('first_name', max_length=auth.FIRST_NAME_MAX_LENGTH))
-        self.define_field(odm.field.String('middle_name', max_length=auth.MIDDLE_NAME_MAX_LENGTH))
-        self.define_field(odm.field.String('last_name', max_length=auth.LAST_NAME_MAX_LENGTH))
-        self.define_field(odm.field.String('position', max_length=auth.USER_POSITION_MAX_LENGTH))
-        self.define_field(odm.field.String('description', max_length=auth.USER_DESCRIPTION_MAX_LENGTH))
-        self.define_field(odm.field.DateTime('birth_date'))
-        self.define_field(odm.field.String('timezone'))
-        self.define_field(odm.field.DateTime('last_sign_in'))
-        self.define_field(odm.field.DateTime('last_activity'))
-        self.define_field(odm.field.Integer('sign_in_count'))
-        self.define_field(odm.field.String('status', default='active'))
-        self.define_field(_field.Roles('roles'))
-        self.define_field(odm.field.Enum('gender', values=('m', 'f')))
-        self.define_field(odm.field.String('phone', max_length=auth.PHONE_MAX_LENGTH))
-        self.define_field(odm.field.Dict('options'))
-        self.define_field(file_storage_odm.field.Image('picture'))
-        self.define_field(file_storage_odm.field.Image('cover_picture'))
-        self.define_field(odm.field.UniqueStringList('urls'))
-        self.define_field(odm.field.Integer('follows_count'))
-        self.define_field(odm.field.Integer('followers_count'))
-        self.define_field(odm.field.Integer('blocked_users_count'))
-        self.define_field(odm.field.String('last_ip'))
-        self.define_field(odm.field.String('country', max_length=auth.COUNTRY_MAX_LENGTH))
-        self.define_field(odm.field.String('province', max_length=auth.PROVINCE_MAX_LENGTH))
-        self.define_field(odm.field.String('city', max_length=auth.CITY_MAX_LENGTH))
-        self.define_field(odm.field.String('district', max_length=auth.DISTRICT_MAX_LENGTH))
-        self.define_field(odm.field.String('street', max_length=auth.STREET_MAX_LENGTH))
-        self.define_field(odm.field.String('building', max_length=auth.BUILDING_MAX_LENGTH))
-        self.define_field(odm.field.String('apt_number', max_length=auth.APT_NUMBER_MAX_LENGTH))
-        self.define_field(odm.field.String('postal_code', max_length=auth.POSTAL_CODE_MAX_LENGTH))
+        _define_fields(self)
 
-    def _setup_indexes(self):
-        """Hook.
+    def _build_indexes(self):
+        """Define indexes, called once per class
         """
         self.define_index([('uid', odm.I_ASC)], unique=True)
         self.define_index([('login', odm.I_ASC)], unique=True)
         self.define_index([('nickname', odm.I_ASC)], unique=True)
         self.define_index([('last_sign_in', odm.I_DESC)])
+        self.define_index([('autocomplete', odm.I_ASC)])
+        self.define_index([('roles', odm.I_ASC)])
 
-        text_index_fields = ['login', 'nickname', 'first_name', 'last_name', 'position', 'city', 'country', 'province',
-                             'district', 'street', 'phone']
         text_index = []
-        for f_name in text_index_fields:
+        for f_name in ['login', 'nickname', 'first_name', 'last_name', 'position', 'city', 'country', 'province',
+                       'district', 'street', 'phone']:
             if self.has_field(f_name) and isinstance(self.get_field(f_name), odm.field.String):
                 text_index.append((f_name, odm.I_TEXT))
+
         self.define_index(text_index, name='text_index')
 
+    def _setup_indexes(self):
+        """Hook.
+        """
+        _define_indexes(self)
+
     def _on_f_get(self, field_name: str, value, **kwargs):
         if field_name == 'picture':
-            if not self.get_field('picture').get_val() and \
+            if not self.get_field('picture').get_val() and reg.get('auth_storage_odm.gravatar', True) and \
                     not (self.is_new or self.is_deleted or self.is_being_deleted):
-                try:
-                    # Load user picture from Gravatar
-                    img_url = 'https://www.gravatar.com/avatar/' + util.md5_hex_digest(self.f_get('login')) + '?s=512'
-                    img = file.create(img_url)
-                    auth.switch_user_to_system()
-                    self.f_set('picture', img).save()
-                    value = img
-                finally:
-                    auth.restore_user()
+                # Load user picture from Gravatar in background, it will be available on next entity load
+                _picture.fetcher.enqueue(self.f_get('uid'))
 
         elif field_name == 'is_confirmed':
             value = not self.f_get('confirmation_hash')
@@ -198,27 +418,35 @@ class ODMUser(odm.model.Entity):
         elif field_name == 'is_confirmed':
             self.f_set('confirmation_hash', util.random_str(64) if not value else None)
 
+        if field_name in ('login', 'nickname') and not self.is_new and value != self.f_get(field_name):
+            # Lookups of the new value may have been cached as failed by any process
+            self._lookup_keys_changed = True
+
         return super()._on_f_set(field_name, value, **kwargs)
 
     def _sanitize_nickname(self, s: str) -> str:
         """Generate unique nickname.
         """
-        cnt = 0
         s = util.transform_str_2(s[:32], lang.get_current())
-        nickname = s
-        while True:
-            try:
-                user = auth.get_user(nickname=nickname)
+        self._nickname_base = s
 
-                # If nickname of THIS user was not changed
-                if user.nickname == self.f_get('nickname'):
-                    return s
+        return _next_free_nickname(s, _get_taken_nicknames(self.collection, (s,), None if self.is_new else self.id))
 
-            except auth.error.UserNotFound:
-                return nickname
+    def save(self, **kwargs):
+        """Save the entity, retrying with another nickname if it has been taken concurrently
+        """
+        attempts = reg.get('auth_storage_odm.nickname_save_attempts', 3)
+        while True:
+            try:
+                return super().save(**kwargs)
+            except DuplicateKeyError as e:
+                attempts -= 1
+                base = getattr(self, '_nickname_base', None)
+                if attempts <= 0 or not base or 'nickname' not in str(e):
+                    raise
 
-            cnt += 1
-            nickname = s + '-' + str(cnt)
+                # Nickname will be sanitized again against the current state of the collection
+                self.f_set('nickname', base)
 
     def _on_pre_save(self, **kwargs):
         """Hook.
@@ -237,21 +465,54 @@ class ODMUser(odm.model.Entity):
             m.update(self.f_get('login').encode('UTF-8'))
             self.f_set('nickname', m.hexdigest())
 
+        self.f_set('autocomplete', _autocomplete.get_keys({f: self.f_get(f) for f in _autocomplete.FIELDS}))
+
+    def _on_after_save(self, first_save: bool = False, **kwargs):
+        """Hook
+        """
+        super()._on_after_save(first_save, **kwargs)
+
+        _cache.users.rm(self.f_get('uid'))
+
+        # New user or changed login or nickname may have been looked up before they were saved
+        if first_save or getattr(self, '_lookup_keys_changed', False):
+            _cache.misses.invalidate()
+            self._lookup_keys_changed = False
+
     def _on_after_delete(self, **kwargs):
         """Hook
         """
+        _cache.users.rm(self.f_get('uid'))
+
+        _relations.delete_user_edges(self.f_get('uid'))
+
         for f_name in ('picture', 'cover_picture'):
             pic = self.f_get(f_name)
             if pic:
                 pic.delete()
 
 
+# Relationship name: (model, field referencing the user, field referencing related users)
+_RELATIONS = {
+    'follows': ('follower', 'follower', 'follows'),
+    'followers': ('follower', 'follows', 'follower'),
+    'blocked_users': ('blocked_user', 'blocker', 'blocked'),
+}
+
+# Indexes serving relationship lookups in reverse direction
+REVERSE_INDEXES = {
+    'follower': [('follows', odm.I_ASC), ('follower', odm.I_ASC)],
+    'blocked_user': [('blocked', odm.I_ASC), ('blocker', odm.I_ASC)],
+}
+
+
 class User(auth.model.AbstractUser):
     def __init__(self, odm_entity: ODMUser):
         if not isinstance(odm_entity, ODMUser):
             raise TypeError('Instance of {} expected, got {}'.format(ODMUser, type(odm_entity)))
 
         self._entity = odm_entity
+        self._counters = None  # type: Optional[Dict[str, int]]
 
     @property
     def odm_entity(self) -> ODMUser:
@@ -270,29 +531,73 @@ class User(auth.model.AbstractUser):
         return self.get_field('_created')
 
     def has_field(self, field_name: str) -> bool:
-        return self._entity.has_field(field_name)
+        return field_name in _relations.COUNTERS or self._entity.has_field(field_name)
+
+    def get_relation_page(self, relation: str, count: int = 10, after: str = None, skip: int = 0) \
+            -> Tuple[List[auth.model.AbstractUser], Optional[str]]:
+        """Get a page of related users: 'follows', 'followers' or 'blocked_users'.
+
+        Returns users and an opaque token to pass as `after` to get the next page, or None if there are no more users.
+        Users are ordered by UID, so the query is covered by a compound index. Users of a page are loaded with single
+        query.
+        """
+        model, own_field, other_field = _RELATIONS[relation]
+        sort = [(other_field, 1)]
+
+        q = {own_field: self.uid}
+        if after:
+            q.update(_pagination.keyset_filter(sort, _pagination.decode_token(after)))
+
+        with _metrics.measure('user.' + relation, (self.uid, count, after, skip)):
+            cursor = odm.dispense(model).collection.find(q, {'_id': 0, other_field: 1}).sort(sort)
+            docs = list(cursor.skip(skip).limit(count + 1))
+
+        next_token = None
+        if len(docs) > count:
+            docs = docs[:count]
+            next_token = _pagination.encode_token([docs[-1][other_field]])
+
+        return _field._get_users([d[other_field] for d in docs]), next_token
+
+    def iter_relation(self, relation: str, page_size: int = 100) -> Iterator[auth.model.AbstractUser]:
+        """Iterate over all related users: 'follows', 'followers' or 'blocked_users', page by page
+        """
+        after = None
+        while True:
+            users, after = self.get_relation_page(relation, page_size, after)
+            yield from users
+            if not after:
+                break
 
     def get_field(self, field_name: str, **kwargs):
-        if field_name == 'follows':
-            f = odm.find('follower').eq('follower', self)
-            return [f.follows for f in f.skip(kwargs.get('skip', 0)).get(kwargs.get('count', 10))]
-        if field_name == 'follows_count':
-            return odm.find('follower').eq('follower', self).count()
-        elif field_name == 'followers':
-            return [f.follower for f in odm.find('follower').eq('follows', self).get()]
-        elif field_name == 'followers_count':
-            return odm.find('follower').eq('follows', self).count()
-        elif field_name == 'blocked_users':
-            return [b.blocked for b in odm.find('blocked_user').eq('blocker', self).get()]
-        elif field_name == 'blocked_users_count':
-            return odm.find('blocked_user').eq('blocker', self).count()
+        if field_name in _RELATIONS:
+            # Without `count` first 10 followed users or all followers and blocked users are returned
+            count = kwargs.get('count')
+            if not count and field_name != 'follows':
+                return list(self.iter_relation(field_name))
+
+            return self.get_relation_page(field_name, count or 10, kwargs.get('after'), kwargs.get('skip', 0))[0]
+        elif field_name in _relations.COUNTERS:
+            # Counters are maintained by add_to_field() and sub_from_field()
+            return self._get_counters()[field_name]
+        elif field_name in _activity.FIELDS and not self._entity.is_new:
+            value = self._entity.f_get(field_name, **kwargs)
+            if _activity.FIELDS[field_name] == '$inc':
+                return (value or 0) + _activity.buffer.get(self.uid, field_name, 0)
+
+            return _activity.buffer.get(self.uid, field_name, value)
 
         return self._entity.f_get(field_name, **kwargs)
 
     def set_field(self, field_name: str, value):
         super().set_field(field_name, value)
 
-        self._entity.f_set(field_name, value)
+        if field_name in _activity.FIELDS and not self._entity.is_new and _activity.buffer.enabled:
+            if _activity.FIELDS[field_name] == '$inc':
+                value = (value or 0) - self.get_field(field_name)
+            _activity.buffer.put(self.uid, field_name, value)
+        else:
+            self._entity.f_set(field_name, value)
 
         return self
 
@@ -300,37 +605,151 @@ class User(auth.model.AbstractUser):
         if field_name == 'follows':
             if not self.is_follows(value):
                 odm.dispense('follower').f_set('follower', self).f_set('follows', value).save()
+                self._inc_counters('follows_count', 'followers_count', value, 1)
         elif field_name == 'blocked_users':
             if not self.is_blocks(value):
                 odm.dispense('blocked_user').f_set('blocker', self).f_set('blocked', value).save()
+                self._inc_counters('blocked_users_count', None, value, 1)
         else:
             self._entity.f_add(field_name, value)
 
         return self
 
+    def _delete_edge(self, relation: str, other_user) -> bool:
+        """Delete a relationship document, returns False if there was none
+        """
+        model, own_field, other_field = _RELATIONS[relation]
+        other_uid = other_user.uid if isinstance(other_user, auth.model.AbstractUser) else other_user
+        r = odm.dispense(model).collection.delete_one({own_field: self.uid, other_field: other_uid})
+
+        return bool(r.deleted_count)
+
     def sub_from_field(self, field_name: str, value):
         if field_name == 'follows':
-            odm.find('follower').eq('follower', self).eq('follows', value).delete()
+            # Counters are decremented only by the call which actually deleted the relationship
+            if self._delete_edge('follows', value):
+                self._inc_counters('follows_count', 'followers_count', value, -1)
         elif field_name == 'blocked_users':
-            odm.find('blocked_user').eq('blocker', self).eq('blocked', value).delete()
+            if self._delete_edge('blocked_users', value):
+                self._inc_counters('blocked_users_count', None, value, -1)
         else:
             self._entity.f_sub(field_name, value)
 
         return self
 
+    def _inc_counters(self, own_counter: str, other_counter: Optional[str], other_user, delta: int):
+        """Helper
+        """
+        deltas = {self.uid: {own_counter: delta}}
+        if other_counter:
+            other_uid = other_user.uid if isinstance(other_user, auth.model.AbstractUser) else other_user
+            deltas.setdefault(other_uid, {})[other_counter] = delta
+
+        _relations.inc_counters(deltas)
+
+        self._apply_counter_deltas({own_counter: delta})
+        if other_counter and hasattr(other_user, '_apply_counter_deltas'):
+            other_user._apply_counter_deltas({other_counter: delta})
+
+    def _get_counters(self) -> Dict[str, int]:
+        """Get relationship counters, they are loaded once per object
+        """
+        if self._counters is None:
+            if self._entity.is_new:
+                self._counters = {c: 0 for c in _relations.COUNTERS}
+            else:
+                self._counters = _relations.get_counters([self.uid])[self.uid]
+
+        return self._counters
+
+    def _apply_counter_deltas(self, deltas: Dict[str, int]):
+        """Update counters loaded into memory after they have been incremented in the database
+        """
+        if self._counters is not None:
+            for counter, delta in deltas.items():
+                self._counters[counter] += delta
+
+    def _get_role_sets(self) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        """Get names and permissions of the user's roles
+        """
+        registry = _role_registry.registry
+        role_uids = tuple(sorted(self._entity.get_field('roles').get_storable_val() or ()))
+        key = (role_uids, registry.version)
+
+        role_sets = _cache.role_sets.get(key)
+        if role_sets is None:
+            roles = registry.get_many(role_uids)
+            role_sets = (frozenset(r['name'] for r in roles),
+                         frozenset(p for r in roles for p in r.get('permissions') or ()))
+            _cache.role_sets.put(key, role_sets)
+
+        return role_sets
+
+    @property
+    def permissions(self) -> FrozenSet[str]:
+        """Get effective permissions of the user
+        """
+        return self._get_role_sets()[1]
+
+    def has_role(self, name: Union[str, Iterable[str]]) -> bool:
+        return not self._get_role_sets()[0].isdisjoint((name,) if isinstance(name, str) else name)
+
+    def has_permission(self, name: str) -> bool:
+        return self.is_admin or name in self._get_role_sets()[1]
+
+    def _filter_related(self, relation: str, users: Iterable[Union[auth.model.AbstractUser, str]]) -> Set[str]:
+        """Get UIDs of users which are related to this one
+        """
+        model, own_field, other_field = _RELATIONS[relation]
+        uids = list({u.uid if isinstance(u, auth.model.AbstractUser) else u for u in users})
+        if not uids:
+            return set()
+
+        # Only indexed fields are projected, so the query is covered by the index
+        q = {own_field: self.uid, other_field: uids[0] if len(uids) == 1 else {'$in': uids}}
+        with _metrics.measure('user.filter_' + relation):
+            cursor = odm.dispense(model).collection.find(q, {'_id': 0, other_field: 1})
+            return {d[other_field] for d in cursor.limit(1 if len(uids) == 1 else 0)}
+
+    def filter_follows(self, users: Iterable[Union[auth.model.AbstractUser, str]]) -> Set[str]:
+        """Get UIDs of users followed by this user
+        """
+        return self._filter_related('follows', users)
+
+    def filter_followed(self, users: Iterable[Union[auth.model.AbstractUser, str]]) -> Set[str]:
+        """Get UIDs of users which follow this user
+        """
+        return self._filter_related('followers', users)
+
+    def filter_blocks(self, users: Iterable[Union[auth.model.AbstractUser, str]]) -> Set[str]:
+        """Get UIDs of users blocked by this user
+        """
+        return self._filter_related('blocked_users', users)
+
     def is_follows(self, user_to_check: auth.model.AbstractUser) -> bool:
-        return bool(odm.find('follower').eq('follower', self).eq('follows', user_to_check).count())
+        return bool(self.filter_follows((user_to_check,)))
 
     def is_followed(self, user_to_check: auth.model.AbstractUser) -> bool:
-        return bool(odm.find('follower').eq('follower', user_to_check).eq('follows', self).count())
+        return bool(self.filter_followed((user_to_check,)))
 
     def is_blocks(self, user_to_check: auth.model.AbstractUser) -> bool:
-        return bool(odm.find('blocked_user').eq('blocker', self).eq('blocked', user_to_check).count())
+        return bool(self.filter_blocks((user_to_check,)))
 
     def do_save(self):
-        self._entity.save()
+        if self._entity.is_new or not _activity.buffer.enabled:
+            self._entity.save()
+            return
+
+        # Buffered activity fields are written by the buffer, so if nothing else has changed, there is nothing to save.
+        # Otherwise the entity is written without them to not overwrite values flushed since it was loaded.
+        self._entity._skip_activity_fields = True
+        try:
+            self._entity.save()
+        finally:
+            self._entity._skip_activity_fields = False
 
     def do_delete(self):
+        _activity.buffer.pop(self.uid)
         self._entity.delete()
 
 
@@ -341,6 +760,7 @@ class ODMFollower(odm.model.Entity):
 
     def _setup_indexes(self):
         self.define_index([('follower', odm.I_ASC), ('follows', odm.I_ASC)], True)
+        self.define_index(REVERSE_INDEXES['follower'])
 
     @property
     def follower(self) -> auth.model.AbstractUser:
@@ -358,6 +778,7 @@ class ODMBlockedUser(odm.model.Entity):
 
     def _setup_indexes(self):
         self.define_index([('blocker', odm.I_ASC), ('blocked', odm.I_ASC)], True)
+        self.define_index(REVERSE_INDEXES['blocked_user'])
 
     @property
     def blocker(self) -> auth.model.AbstractUser:
@@ -0,0 +1,92 @@
+"""PytSite Auth ODM Storage Keyset Pagination
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import Any, List, Optional, Tuple
+from bson import json_util
+from plugins import odm, query
+from . import _query
+
+
+def encode_token(values: List[Any]) -> str:
+    """Build an opaque page token from sort key values
+    """
+    return urlsafe_b64encode(json_util.dumps(values).encode('UTF-8')).decode('ASCII')
+
+
+def decode_token(token: str) -> List[Any]:
+    """Get sort key values from a page token
+    """
+    try:
+        values = json_util.loads(urlsafe_b64decode(token.encode('ASCII')).decode('UTF-8'))
+    except ValueError as e:
+        raise ValueError('Invalid page token: {}'.format(e))
+
+    if not isinstance(values, list):
+        raise ValueError('Invalid page token')
+
+    return values
+
+
+def _after(field: str, order: int, value: Any) -> Optional[dict]:
+    """Get condition matching values which follow `value` in sort order
+    """
+    # Nulls go first in ascending order and last in descending one
+    if value is None:
+        return {field: {'$ne': None}} if order > 0 else None
+
+    if order > 0:
+        return {field: {'$gt': value}}
+
+    return {'$or': [{field: {'$lt': value}}, {field: None}]}
+
+
+def keyset_filter(sort: List[Tuple[str, int]], values: List[Any]) -> dict:
+    """Get filter matching documents which follow the ones with given sort key values
+    """
+    if len(sort) != len(values):
+        raise ValueError('Page token does not match sort order')
+
+    conditions = []
+    for i, (field, order) in enumerate(sort):
+        after = _after(field, order, values[i])
+        if after is not None:
+            condition = {f: values[j] for j, (f, _) in enumerate(sort[:i])}
+            condition.update(after)
+            conditions.append(condition)
+
+    return {'$or': conditions} if conditions else {'_id': {'$exists': False}}
+
+
+def find_page(model: str, query: query.Query = None, sort: List[Tuple[str, int]] = None, limit: int = 100,
+              after: str = None) -> Tuple[List[odm.model.Entity], Optional[str]]:
+    """Find a page of entities.
+
+    `_id` is appended to the sort key to make it unique. Returns entities and token of the next page, which is None if
+    there are no more entities.
+    """
+    sort = list(sort or [])
+    if not sort or sort[-1][0] != '_id':
+        sort.append(('_id', 1))
+
+    conditions = [_query.compile_query(model, query)] if query else []
+    if after:
+        conditions.append(keyset_filter(sort, decode_token(after)))
+    q = {'$and': conditions} if conditions else {}
+
+    # Fetch keys only, entities are loaded with single query afterwards
+    projection = {f: 1 for f, _ in sort}
+    docs = list(odm.dispense(model).collection.find(q, projection).sort(sort).limit(limit + 1))
+
+    next_token = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_token = encode_token([docs[-1].get(f) for f, _ in sort])
+
+    ids = [d['_id'] for d in docs]
+    entities = {e.id: e for e in odm.find(model).cache(0).inc('_id', ids).get()} if ids else {}
+
+    return [entities[i] for i in ids if i in entities], next_token
@@ -0,0 +1,79 @@
+"""PytSite Auth ODM Storage User Pictures Fetcher
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import threading as _threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Set
+from pytsite import logger, reg, util
+from plugins import auth, file, odm
+
+
+def get_gravatar_url(login: str) -> str:
+    """Get Gravatar image URL for a login
+    """
+    return reg.get('auth_storage_odm.gravatar_url', 'https://www.gravatar.com/avatar/') + \
+        util.md5_hex_digest(login) + '?s=512'
+
+
+def fetch(uid: str) -> bool:
+    """Load picture of a user from Gravatar and save it.
+
+    Returns False if the user does not exist or already has a picture.
+    """
+    entity = odm.find('user').cache(0).eq('uid', uid).first()  # type: odm.model.Entity
+    if not entity or entity.get_field('picture').get_val():
+        return False
+
+    img = file.create(get_gravatar_url(entity.f_get('login')))
+    try:
+        auth.switch_user_to_system()
+        entity.f_set('picture', img).save()
+    finally:
+        auth.restore_user()
+
+    return True
+
+
+class PictureFetcher:
+    """Background fetcher of users' pictures.
+
+    Each user is queued at most once until its fetch is completed.
+    """
+
+    def __init__(self):
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        self._pending = set()  # type: Set[str]
+        self._lock = _threading.Lock()
+
+    def _task(self, uid: str) -> bool:
+        try:
+            return fetch(uid)
+        except Exception as e:
+            logger.warn("Cannot fetch picture of user '{}': {}".format(uid, e))
+            return False
+        finally:
+            with self._lock:
+                self._pending.discard(uid)
+
+    def enqueue(self, uid: str) -> Optional[Future]:
+        """Queue picture fetch for a user.
+
+        Returns None if the user is already queued.
+        """
+        with self._lock:
+            if uid in self._pending:
+                return None
+
+            if not self._executor:
+                self._executor = ThreadPoolExecutor(reg.get('auth_storage_odm.gravatar_workers', 4),
+                                                    'auth_storage_odm.picture')
+
+            self._pending.add(uid)
+
+            return self._executor.submit(self._task, uid)
+
+
+fetcher = PictureFetcher()
@@ -0,0 +1,19 @@
+"""PytSite Auth ODM Storage Queries
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from plugins import odm, query
+
+
+def compile_query(model: str, q: query.Query = None) -> dict:
+    """Get MongoDB filter of a query.
+
+    Query is compiled by the ODM finder, so its arguments, like users or roles, are sanitized by model's fields the same
+    way as in `odm.find()` results.
+    """
+    if not q:
+        return {}
+
+    return odm.find(model, query=q).query.compile()
@@ -0,0 +1,200 @@
+"""PytSite Auth ODM Storage Relationships Maintenance
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+from itertools import islice
+from typing import Dict, Iterable, List
+from pymongo import UpdateOne
+from pytsite import console, mongodb, reg
+from plugins import odm
+from . import _cache
+
+# Counters are kept apart from users' documents, which are overwritten by full entity saves
+COUNTERS_COLLECTION = 'auth_storage_odm_counters'
+
+# User counter field: (relationship model, field referencing counted user)
+COUNTERS = {
+    'follows_count': ('follower', 'follower'),
+    'followers_count': ('follower', 'follows'),
+    'blocked_users_count': ('blocked_user', 'blocker'),
+}
+
+# Relationship model: {field referencing a user: counter of that user}
+EDGE_COUNTERS = {
+    'follower': {'follower': 'follows_count', 'follows': 'followers_count'},
+    'blocked_user': {'blocker': 'blocked_users_count', 'blocked': None},
+}
+
+
+def _other_field(model: str, field: str) -> str:
+    return [f for f in EDGE_COUNTERS[model] if f != field][0]
+
+
+def _delete_edges(model: str, docs: List[dict], keep_uids: set, deltas: Dict[str, Dict[str, int]]):
+    """Delete edges and compute counter deltas of users which are kept
+    """
+    odm.dispense(model).collection.delete_many({'_id': {'$in': [d['_id'] for d in docs]}})
+
+    for d in docs:
+        for field, counter in EDGE_COUNTERS[model].items():
+            uid = d.get(field)
+            if counter and uid in keep_uids:
+                user_deltas = deltas.setdefault(uid, {})
+                user_deltas[counter] = user_deltas.get(counter, 0) - 1
+
+
+def counters_collection():
+    """Get collection of users' relationship counters, documents are indexed by user UIDs
+    """
+    return mongodb.get_collection(COUNTERS_COLLECTION)
+
+
+def get_counters(uids: Iterable[str]) -> Dict[str, Dict[str, int]]:
+    """Get relationship counters of users, indexed by user UIDs
+    """
+    uids = list(uids)
+    docs = {d['_id']: d for d in counters_collection().find({'_id': {'$in': uids}})}
+
+    return {uid: {c: docs.get(uid, {}).get(c) or 0 for c in COUNTERS} for uid in uids}
+
+
+def inc_counters(deltas: Dict[str, Dict[str, int]]):
+    """Atomically increment users' counters.
+
+    `deltas` is a dict of counter deltas dicts indexed by user UIDs.
+    """
+    requests = [UpdateOne({'_id': uid}, {'$inc': d}, upsert=True) for uid, d in deltas.items() if any(d.values())]
+    if not requests:
+        return
+
+    counters_collection().bulk_write(requests, ordered=False)
+
+    for uid in deltas:
+        _cache.users.rm(uid)
+
+
+def _count_edges(uids: List[str]) -> Dict[str, Dict[str, int]]:
+    """Count relationships of users, indexed by counter names and user UIDs
+    """
+    r = {}
+    for counter, (model, field) in COUNTERS.items():
+        pipeline = [{'$match': {field: {'$in': uids}}}, {'$group': {'_id': '$' + field, 'n': {'$sum': 1}}}]
+        r[counter] = {d['_id']: d['n'] for d in odm.dispense(model).collection.aggregate(pipeline)}
+
+    return r
+
+
+def reconcile_counters(dry_run: bool = False, uids: Iterable[str] = None) -> int:
+    """Recompute users' relationship counters from relationship collections.
+
+    If `uids` is given, only counters of these users are recomputed, otherwise all users are walked. Users are processed
+    in chunks, so memory usage does not depend on their number. Returns number of users whose counters were wrong.
+    """
+    chunk_size = reg.get('auth_storage_odm.migration_chunk_size', 1000)
+    counters = counters_collection()
+    fixed = 0
+    requests = []
+
+    if uids is None:
+        cursor = odm.dispense('user').collection.find({}, {'_id': 0, 'uid': 1}, batch_size=chunk_size)
+        uids_iter = (d['uid'] for d in cursor)
+    else:
+        uids_iter = iter(uids)
+
+    while True:
+        chunk = list(islice(uids_iter, chunk_size))
+        if not chunk:
+            break
+
+        actual = _count_edges(chunk)
+        stored = {d['_id']: d for d in counters.find({'_id': {'$in': chunk}})}
+
+        for uid in chunk:
+            values = {}
+            for counter in COUNTERS:
+                n = actual[counter].get(uid, 0)
+                if (stored.get(uid, {}).get(counter) or 0) != n:
+                    values[counter] = n
+
+            if values:
+                fixed += 1
+                requests.append(UpdateOne({'_id': uid}, {'$set': values}, upsert=True))
+
+        if len(requests) >= chunk_size:
+            if not dry_run:
+                counters.bulk_write(requests, ordered=False)
+            requests = []
+
+    if requests and not dry_run:
+        counters.bulk_write(requests, ordered=False)
+
+    console.print_info('Relationship counters of {} users {}fixed'.format(fixed, 'to be ' if dry_run else ''))
+
+    return fixed
+
+
+def delete_user_edges(uid: str) -> int:
+    """Delete all relationships and counters of a user and decrement counters of related users.
+
+    Returns number of deleted relationships.
+    """
+    chunk_size = reg.get('auth_storage_odm.migration_chunk_size', 1000)
+    deleted = 0
+
+    for model in EDGE_COUNTERS:
+        collection = odm.dispense(model).collection
+        for field in EDGE_COUNTERS[model]:
+            other_field = _other_field(model, field)
+            while True:
+                docs = list(collection.find({field: uid}, {'_id': 1, field: 1, other_field: 1}).limit(chunk_size))
+                if not docs:
+                    break
+
+                deltas = {}
+                _delete_edges(model, docs, {d[other_field] for d in docs}, deltas)
+                inc_counters(deltas)
+                deleted += len(docs)
+
+    counters_collection().delete_one({'_id': uid})
+
+    return deleted
+
+
+def sweep_orphan_edges(dry_run: bool = False) -> int:
+    """Delete relationships which refer to non-existent users and fix counters of existing ones.
+
+    Returns number of orphaned relationships.
+    """
+    chunk_size = reg.get('auth_storage_odm.migration_chunk_size', 1000)
+    users = odm.dispense('user').collection
+    orphans = 0
+
+    for model, fields in EDGE_COUNTERS.items():
+        collection = odm.dispense(model).collection
+        projection = dict({'_id': 1}, **{f: 1 for f in fields})
+        last_id = None
+
+        while True:
+            q = {'_id': {'$gt': last_id}} if last_id else {}
+            docs = list(collection.find(q, projection).sort('_id', 1).limit(chunk_size))
+            if not docs:
+                break
+            last_id = docs[-1]['_id']
+
+            uids = list({d.get(f) for d in docs for f in fields})
+            existing = {d['uid'] for d in users.find({'uid': {'$in': uids}}, {'_id': 0, 'uid': 1})}
+            orphan_docs = [d for d in docs if any(d.get(f) not in existing for f in fields)]
+            if not orphan_docs:
+                continue
+
+            orphans += len(orphan_docs)
+            if not dry_run:
+                deltas = {}
+                _delete_edges(model, orphan_docs, existing, deltas)
+                inc_counters(deltas)
+
+    console.print_info('{} orphaned relationships {}deleted'.format(orphans, 'to be ' if dry_run else ''))
+
+    return orphans
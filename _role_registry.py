@@ -0,0 +1,82 @@
+"""PytSite Auth ODM Storage Role Registry
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import threading as _threading
+from typing import Dict, List, Optional
+from plugins import odm
+from . import _cache
+
+
+class RoleRegistry:
+    """In-process registry of all roles.
+
+    Roles' documents are loaded into memory at once and indexed by UID and name. Every change of a role increments a
+    version counter stored in the database, and each process reloads roles when the counter differs from the version
+    of its own copy. Documents are shared between threads and must never be modified.
+    """
+
+    def __init__(self):
+        self._by_uid = {}  # type: Dict[str, dict]
+        self._by_name = {}  # type: Dict[str, dict]
+        self._version = None  # type: Optional[int]
+        self._stamp = _cache.VersionStamp('role')
+        self._lock = _threading.RLock()
+
+    @property
+    def version(self) -> int:
+        """Get version of the loaded roles set
+        """
+        self._refresh()
+
+        return self._version
+
+    def load(self):
+        """(Re)load all roles from the database
+        """
+        with self._lock:
+            version = self._stamp.get()
+
+            by_uid = {}
+            by_name = {}
+            for doc in odm.dispense('role').collection.find():
+                by_uid[doc['uid']] = doc
+                by_name[doc['name']] = doc
+
+            self._by_uid, self._by_name, self._version = by_uid, by_name, version
+
+    def _refresh(self):
+        if self._version != self._stamp.get():
+            self.load()
+
+    def bump_version(self):
+        """Notify all processes about roles change
+        """
+        self._stamp.bump()
+
+    def get(self, name: str = None, uid: str = None) -> Optional[dict]:
+        """Get a role document by name or UID
+        """
+        self._refresh()
+
+        return self._by_name.get(name) if name is not None else self._by_uid.get(uid)
+
+    def get_many(self, uids: List[str]) -> List[dict]:
+        """Get role documents by UIDs, preserving order and skipping non-existent ones
+        """
+        self._refresh()
+        by_uid = self._by_uid
+
+        return [by_uid[uid] for uid in uids if uid in by_uid]
+
+    def get_all(self) -> List[dict]:
+        """Get all role documents
+        """
+        self._refresh()
+
+        return list(self._by_uid.values())
+
+
+registry = RoleRegistry()
@@ -0,0 +1,245 @@
+"""PytSite Auth ODM Storage Read-Only Snapshots
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import copy
+from typing import Any, Dict, Iterable, List, Optional
+from plugins import auth, file, odm
+from . import _activity, _field, _model, _relations
+
+# Fields which are always fetched
+_REQUIRED_FIELDS = ('_id', 'uid', 'login', 'nickname')
+
+# Fields which are computed by the entity and cannot be served from raw document
+_COMPUTED_FIELDS = ('follows', 'followers', 'blocked_users')
+
+# Default values of user entity's fields, indexed by field names
+_user_defaults = None  # type: Optional[Dict[str, Any]]
+
+
+def _get_user_defaults() -> Dict[str, Any]:
+    """Get default values of user entity's fields, they are read from an entity only once
+    """
+    global _user_defaults
+
+    if _user_defaults is None:
+        entity = odm.dispense('user')
+        _user_defaults = {f_name: f.get_val() for f_name, f in entity.fields.items()
+                          if not isinstance(f, odm.field.Virtual)}
+
+    return _user_defaults
+
+
+def get_projection(fields: Iterable[str] = None) -> Optional[dict]:
+    """Get MongoDB projection for a list of fields, None means all fields
+    """
+    if fields is None:
+        return None
+
+    projection = {f: 1 for f in _REQUIRED_FIELDS}
+    for f in fields:
+        if f == 'is_confirmed':
+            f = 'confirmation_hash'
+        elif f in ('created', 'modified'):
+            f = '_' + f
+        elif f == 'full_name':
+            projection.update({'first_name': 1, 'middle_name': 1})
+            f = 'last_name'
+        projection[f] = 1
+
+    return projection
+
+
+class UserSnapshot(auth.model.AbstractUser):
+    """Read-only user built directly from a database document.
+
+    If the document is `partial`, i.e. contains a subset of fields, the ones which were not fetched are read from the
+    full user, which is loaded on first such access. Fields missing in a full document have their default values.
+    """
+
+    def __init__(self, doc: dict, user_cls: type = _model.User, partial: bool = False):
+        self._doc = doc
+        self._partial = partial
+        self._user_cls = user_cls
+        self._user = None  # type: Optional[_model.User]
+        self._counters = None  # type: Optional[Dict[str, int]]
+
+    def to_user(self) -> _model.User:
+        """Get full user, which can be modified
+        """
+        if self._user is None:
+            entity = odm.find('user').cache(0).eq('_id', self._doc['_id']).first()
+            if not entity:
+                raise auth.error.UserNotFound()
+            self._user = self._user_cls(entity)
+
+        return self._user
+
+    @property
+    def is_new(self) -> bool:
+        return False
+
+    @property
+    def is_modified(self) -> bool:
+        return False
+
+    @property
+    def created(self) -> str:
+        return self.get_field('_created')
+
+    def has_field(self, field_name: str) -> bool:
+        if self._user is not None:
+            return self._user.has_field(field_name)
+
+        return field_name in self._doc or field_name in _relations.COUNTERS or field_name == 'is_confirmed' \
+            or field_name in _get_user_defaults()
+
+    def get_field(self, field_name: str, **kwargs):
+        if self._user is not None or field_name in _COMPUTED_FIELDS:
+            return self.to_user().get_field(field_name, **kwargs)
+
+        doc = self._doc
+
+        if field_name in _relations.COUNTERS:
+            if self._counters is None:
+                self._counters = _relations.get_counters([doc['uid']])[doc['uid']]
+            return self._counters[field_name]
+
+        if field_name == 'is_confirmed' and ('confirmation_hash' in doc or not self._partial):
+            return not doc.get('confirmation_hash')
+
+        if field_name in doc:
+            value = doc[field_name]
+        elif not self._partial and field_name in _get_user_defaults():
+            value = copy.copy(_get_user_defaults()[field_name])
+        else:
+            return self.to_user().get_field(field_name, **kwargs)
+
+        if field_name in _activity.FIELDS:
+            if _activity.FIELDS[field_name] == '$inc':
+                return (value or 0) + _activity.buffer.get(doc['uid'], field_name, 0)
+            return _activity.buffer.get(doc['uid'], field_name, value)
+
+        if field_name == 'roles':
+            return _field._get_roles(list(value or ()))
+
+        if field_name in ('picture', 'cover_picture'):
+            return file.get(value) if value else None
+
+        return value
+
+    def set_field(self, field_name: str, value):
+        raise RuntimeError('User snapshot is read-only')
+
+    def add_to_field(self, field_name: str, value):
+        raise RuntimeError('User snapshot is read-only')
+
+    def sub_from_field(self, field_name: str, value):
+        raise RuntimeError('User snapshot is read-only')
+
+    def _apply_counter_deltas(self, deltas: Dict[str, int]):
+        """Update counters loaded into memory after they have been incremented in the database
+        """
+        if self._user is not None:
+            self._user._apply_counter_deltas(deltas)
+
+        if self._counters is not None:
+            for counter, delta in deltas.items():
+                self._counters[counter] += delta
+
+    def is_follows(self, user_to_check: auth.model.AbstractUser) -> bool:
+        return self.to_user().is_follows(user_to_check)
+
+    def is_followed(self, user_to_check: auth.model.AbstractUser) -> bool:
+        return self.to_user().is_followed(user_to_check)
+
+    def is_blocks(self, user_to_check: auth.model.AbstractUser) -> bool:
+        return self.to_user().is_blocks(user_to_check)
+
+    def do_save(self):
+        raise RuntimeError('User snapshot is read-only')
+
+    def do_delete(self):
+        raise RuntimeError('User snapshot is read-only')
+
+
+class RoleSnapshot(auth.model.AbstractRole):
+    """Read-only role built directly from a database document
+    """
+
+    def __init__(self, doc: dict, role_cls: type = _model.Role):
+        self._doc = doc
+        self._role_cls = role_cls
+
+    def to_role(self) -> _model.Role:
+        """Get full role, which can be modified
+        """
+        entity = odm.find('role').cache(0).eq('_id', self._doc['_id']).first()
+        if not entity:
+            raise auth.error.RoleNotFound(self._doc.get('name'))
+
+        return self._role_cls(entity)
+
+    @property
+    def is_new(self) -> bool:
+        return False
+
+    @property
+    def is_modified(self) -> bool:
+        return False
+
+    @property
+    def created(self) -> str:
+        return self.get_field('_created')
+
+    def has_field(self, field_name: str) -> bool:
+        return field_name in self._doc
+
+    def get_field(self, field_name: str, **kwargs):
+        value = self._doc.get(field_name)
+
+        # Document may be shared, so mutable values are copied
+        return copy.copy(value) if isinstance(value, (list, dict)) else value
+
+    def set_field(self, field_name: str, value):
+        raise RuntimeError('Role snapshot is read-only')
+
+    def add_to_field(self, field_name: str, value):
+        raise RuntimeError('Role snapshot is read-only')
+
+    def sub_from_field(self, field_name: str, value):
+        raise RuntimeError('Role snapshot is read-only')
+
+    def do_save(self):
+        raise RuntimeError('Role snapshot is read-only')
+
+    def do_delete(self):
+        raise RuntimeError('Role snapshot is read-only')
+
+
+def find_users(q: dict, fields: List[str] = None, sort: list = None, limit: int = None, skip: int = 0,
+               user_cls: type = _model.User) -> Iterable[UserSnapshot]:
+    """Find users snapshots
+    """
+    cursor = odm.dispense('user').collection.find(q, get_projection(fields)).skip(skip)
+    if sort:
+        cursor.sort(sort)
+    if limit:
+        cursor.limit(limit)
+
+    return (UserSnapshot(doc, user_cls, fields is not None) for doc in cursor)
+
+
+def find_roles(q: dict, sort: list = None, limit: int = None, skip: int = 0,
+               role_cls: type = _model.Role) -> Iterable[RoleSnapshot]:
+    """Find roles snapshots
+    """
+    cursor = odm.dispense('role').collection.find(q).skip(skip)
+    if sort:
+        cursor.sort(sort)
+    if limit:
+        cursor.limit(limit)
+
+    return (RoleSnapshot(doc, role_cls) for doc in cursor)
@@ -0,0 +1,181 @@
+"""PytSite Auth ODM Storage Export and Import
+"""
+__author__ = 'Oleksandr Shepetko'
+__email__ = 'a@shepetko.com'
+__license__ = 'MIT'
+
+import gzip
+import os
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple
+from bson import BSON, decode_file_iter, json_util
+from pymongo.errors import BulkWriteError
+from pytsite import console, reg
+from plugins import odm
+from . import _cache, _relations, _role_registry
+
+# Models in order of import, referenced ones go first
+MODELS = ('role', 'user', 'follower', 'blocked_user')
+
+FORMATS = ('jsonl', 'bson')
+
+_DUPLICATE_KEY_ERROR = 11000
+
+
+def _file_path(dir_path: str, model: str, fmt: str) -> str:
+    return os.path.join(dir_path, '{}.{}.gz'.format(model, fmt))
+
+
+def _write_docs(path: str, fmt: str, docs: Iterable[dict]) -> int:
+    n = 0
+    if fmt == 'jsonl':
+        with gzip.open(path, 'wt', encoding='UTF-8') as f:
+            for doc in docs:
+                f.write(json_util.dumps(doc, json_options=json_util.CANONICAL_JSON_OPTIONS) + '\n')
+                n += 1
+    else:
+        with gzip.open(path, 'wb') as f:
+            for doc in docs:
+                f.write(BSON.encode(doc))
+                n += 1
+
+    return n
+
+
+def _read_docs(path: str, fmt: str) -> Iterator[dict]:
+    if fmt == 'jsonl':
+        with gzip.open(path, 'rt', encoding='UTF-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json_util.loads(line)
+    else:
+        with gzip.open(path, 'rb') as f:
+            yield from decode_file_iter(f)
+
+
+def _is_existing_doc_error(err: dict) -> bool:
+    """Check if a write error is caused by a document which already exists, i.e. has the same `_id`
+    """
+    if err.get('code') != _DUPLICATE_KEY_ERROR:
+        return False
+
+    key_pattern = err.get('keyPattern')
+    if key_pattern is not None:
+        return list(key_pattern) == ['_id']
+
+    # Servers before 4.2 do not report key pattern
+    return ' index: _id_ ' in err.get('errmsg', '')
+
+
+def _insert_chunk(collection, docs: list) -> Tuple[int, int, List[str]]:
+    """Insert documents, skipping existing ones.
+
+    Returns numbers of inserted and skipped documents and messages of unique index conflicts with other documents.
+    """
+    try:
+        collection.insert_many(docs, ordered=False)
+        return len(docs), 0, []
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', ())
+        fatal = [err for err in errors if err.get('code') != _DUPLICATE_KEY_ERROR]
+        if fatal:
+            raise RuntimeError('Cannot import documents: {}'.format(fatal[0].get('errmsg')))
+
+        skipped = [err for err in errors if _is_existing_doc_error(err)]
+        conflicts = [err.get('errmsg', 'Duplicate key error') for err in errors if not _is_existing_doc_error(err)]
+
+        return e.details.get('nInserted', 0), len(skipped), conflicts
+
+
+def export_data(dir_path: str, fmt: str = 'jsonl', models: Iterable[str] = MODELS,
+                batch_size: int = None) -> Dict[str, int]:
+    """Export collections to gzipped files, one per model.
+
+    Documents are written as they are stored, so password hashes and UIDs are preserved. Returns number of exported
+    documents per model.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Invalid format: '{}'".format(fmt))
+
+    batch_size = batch_size or reg.get('auth_storage_odm.migration_chunk_size', 1000)
+    os.makedirs(dir_path, exist_ok=True)
+    r = {}
+
+    for model in models:
+        cursor = odm.dispense(model).collection.find({}, batch_size=batch_size).sort('_id', 1)
+        r[model] = _write_docs(_file_path(dir_path, model, fmt), fmt, cursor)
+        console.print_info("{} '{}' documents exported".format(r[model], model))
+
+    return r
+
+
+def import_data(dir_path: str, fmt: str = 'jsonl', models: Iterable[str] = MODELS, batch_size: int = None,
+                validate: bool = True) -> Dict[str, int]:
+    """Import collections from files created by `export_data()`.
+
+    Documents are inserted in unordered chunks, ones with already existing IDs are skipped. Documents which conflict
+    with other existing ones by unique fields, like users' logins, are reported as errors. Files of missing models are
+    ignored. Returns number of imported documents per model.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Invalid format: '{}'".format(fmt))
+
+    batch_size = batch_size or reg.get('auth_storage_odm.migration_chunk_size', 1000)
+    r = {}
+
+    for model in models:
+        path = _file_path(dir_path, model, fmt)
+        if not os.path.exists(path):
+            continue
+
+        collection = odm.dispense(model).collection
+        docs = _read_docs(path, fmt)
+        inserted = skipped = failed = 0
+        while True:
+            chunk = list(islice(docs, batch_size))
+            if not chunk:
+                break
+
+            n_inserted, n_skipped, conflicts = _insert_chunk(collection, chunk)
+            inserted += n_inserted
+            skipped += n_skipped
+            failed += len(conflicts)
+            for msg in conflicts:
+                console.print_error(msg)
+
+        r[model] = inserted
+        console.print_info("{} '{}' documents imported, {} existing skipped, {} failed".
+                           format(inserted, model, skipped, failed))
+
+    # Imported documents bypass entities, so caches must be reset explicitly
+    _cache.users.clear()
+    _cache.misses.invalidate()
+    _role_registry.registry.bump_version()
+
+    # Relationship counters are not exported, they are recomputed from imported relationships
+    if r.get('follower') or r.get('blocked_user'):
+        _relations.reconcile_counters()
+
+    if validate:
+        validate_refs()
+
+    return r
+
+
+def validate_refs() -> Dict[str, int]:
+    """Check that users' roles and relationships refer to existing entities.
+
+    Returns number of invalid references per model.
+    """
+    batch_size = reg.get('auth_storage_odm.migration_chunk_size', 1000)
+    role_uids = {d['uid'] for d in odm.dispense('role').collection.find({}, {'_id': 0, 'uid': 1})}
+
+    invalid_roles = 0
+    cursor = odm.dispense('user').collection.find({'roles': {'$nin': [[], None]}}, {'_id': 0, 'roles': 1},
+                                                  batch_size=batch_size)
+    for d in cursor:
+        invalid_roles += len([uid for uid in d['roles'] if uid not in role_uids])
+
+    console.print_info('{} references to non-existent roles found'.format(invalid_roles))
+
+    return {'user': invalid_roles, 'relations': _relations.sweep_orphan_edges(dry_run=True)}